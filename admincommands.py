@@ -1,10 +1,13 @@
 import asyncio
+import io
 import typing
 from datetime import datetime, timezone
 
 import discord
 from discord.ext import commands
 
+import database
+import perfstats
 import scheduler
 from timeconverter import time_converter
 
@@ -59,6 +62,37 @@ class AdminCommands(commands.Cog, command_attrs=dict(hidden=True)):
         scheduletime = datetime.now(tz=timezone.utc) + time
         await scheduler.schedule(scheduletime, "message", {"channel": ctx.channel.id, "message": message})
 
+    @commands.command()
+    @commands.is_owner()
+    async def querystats(self, ctx, top: int = 15):
+        """
+        show the SQL statements that have taken the most total time since startup
+        :param ctx: discord context
+        :param top: how many statements to show
+        """
+        stats = sorted(database.querystats.items(), key=lambda kv: kv[1].total, reverse=True)[:top]
+        table = perfstats.stats_table(stats)
+        if len(table) < 1990:
+            await ctx.reply(f"```{table}```")
+        else:
+            with io.StringIO(table) as buf:
+                await ctx.reply(f"Top {len(stats)} statements by total time.",
+                                file=discord.File(buf, filename="querystats.txt"))
+
+    @commands.command()
+    @commands.is_owner()
+    async def schedulestats(self, ctx):
+        """
+        show how late scheduled events have been starting and how long they take, per event type
+        :param ctx: discord context
+        """
+        if not scheduler.eventstats:
+            await ctx.reply("No events have run since startup.")
+            return
+        await ctx.reply(f"```{scheduler.stats_table()}```\n"
+                        f"{len(scheduler.loadedtasks)} event(s) loaded, up to "
+                        f"{discord.utils.format_dt(scheduler.loaded_until)}.")
+
 
 '''
 Steps to convert:
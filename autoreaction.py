@@ -36,7 +36,7 @@ class AutoReactionCog(commands.Cog, name="AutoReaction"):
         await database.db.execute(
             "REPLACE INTO auto_reactions(guild,channel,emoji,react_to_threads) VALUES (?,?,?,?)",
             (ctx.guild.id, channel.id, emoji.id, react_to_threads))
-        await database.db.commit()
+        await database.commit()
         await ctx.reply(f"✔️ I will now react to all messages in {channel.mention} with {emoji}.")
         await modlog(
             f"{ctx.author.mention} (`{ctx.author}`) added new autoreaction rule ({emoji} in {channel.mention})",
@@ -60,7 +60,7 @@ class AutoReactionCog(commands.Cog, name="AutoReaction"):
         cur = await database.db.execute(
             "DELETE FROM auto_reactions WHERE channel=? AND emoji=?",
             (channel.id, emoji.id))
-        await database.db.commit()
+        await database.commit()
         if cur.rowcount > 0:
             await ctx.reply(f"✔️ Removed autoreaction rule for {channel.mention}.")
             await modlog(f"{ctx.author.mention} (`{ctx.author}`) removed autoreaction rule "
@@ -74,8 +74,8 @@ class AutoReactionCog(commands.Cog, name="AutoReaction"):
         """
         list all autoreaction rules
         """
-        async with database.db.execute("SELECT * FROM auto_reactions WHERE guild=?",
-                                       (ctx.guild.id,)) as cursor:
+        async with database.read("SELECT * FROM auto_reactions WHERE guild=?",
+                                 (ctx.guild.id,)) as cursor:
             arrules = await cursor.fetchall()
         outstr = f"{len(arrules)} autoreaction rule{'' if len(arrules) == 1 else 's'}:\n"
         for rule in arrules:
@@ -94,33 +94,35 @@ class AutoReactionCog(commands.Cog, name="AutoReaction"):
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         parentid = message.channel.parent_id if isinstance(message.channel, discord.Thread) else -1
-        async with database.db.execute("SELECT * FROM auto_reactions WHERE channel=? "
-                                       "OR (react_to_threads=true AND channel=?)",
-                                       (message.channel.id, parentid)) as cursor:
-            async for emid in cursor:
+        async with database.read("SELECT * FROM auto_reactions WHERE channel=? "
+                                 "OR (react_to_threads=true AND channel=?)",
+                                 (message.channel.id, parentid)) as cursor:
+            rules = await cursor.fetchall()
+        for emid in rules:
+            emoji = discord.utils.get(message.guild.emojis, id=emid[2])
+            if emoji is None:
+                await database.db.execute("DELETE FROM auto_reactions WHERE channel=? AND emoji=?",
+                                          (emid[1], emid[2]))
+                await database.commit()
+                await modlog(f"Removed autoreaction rule from {message.channel.mention} because emoji with id "
+                             f"`{emid[2]}` no longer exists.", message.guild.id)
+            else:
+                asyncio.create_task(message.add_reaction(emoji))
+
+    @commands.Cog.listener()
+    async def on_thread_create(self, thread: discord.Thread):
+        if isinstance(thread.parent, discord.ForumChannel):
+            message = [message async for message in thread.history(limit=1, oldest_first=True)][0]
+            async with database.read("SELECT * FROM auto_reactions WHERE channel=? ",
+                                     (thread.parent_id,)) as cursor:
+                rules = await cursor.fetchall()
+            for emid in rules:
                 emoji = discord.utils.get(message.guild.emojis, id=emid[2])
                 if emoji is None:
                     await database.db.execute("DELETE FROM auto_reactions WHERE channel=? AND emoji=?",
                                               (emid[1], emid[2]))
-                    await database.db.commit()
+                    await database.commit()
                     await modlog(f"Removed autoreaction rule from {message.channel.mention} because emoji with id "
                                  f"`{emid[2]}` no longer exists.", message.guild.id)
                 else:
                     asyncio.create_task(message.add_reaction(emoji))
-
-    @commands.Cog.listener()
-    async def on_thread_create(self, thread: discord.Thread):
-        if isinstance(thread.parent, discord.ForumChannel):
-            message = [message async for message in thread.history(limit=1, oldest_first=True)][0]
-            async with database.db.execute("SELECT * FROM auto_reactions WHERE channel=? ",
-                                           (thread.parent_id,)) as cursor:
-                async for emid in cursor:
-                    emoji = discord.utils.get(message.guild.emojis, id=emid[2])
-                    if emoji is None:
-                        await database.db.execute("DELETE FROM auto_reactions WHERE channel=? AND emoji=?",
-                                                  (emid[1], emid[2]))
-                        await database.db.commit()
-                        await modlog(f"Removed autoreaction rule from {message.channel.mention} because emoji with id "
-                                     f"`{emid[2]}` no longer exists.", message.guild.id)
-                    else:
-                        asyncio.create_task(message.add_reaction(emoji))
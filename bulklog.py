@@ -7,8 +7,8 @@ import typing
 import discord
 from discord.ext import commands
 
-import database
 import embedutils
+import serverconfig
 
 
 class BulkLog(commands.Cog):
@@ -41,11 +41,9 @@ class BulkLog(commands.Cog):
         :param embed: embed object, passed through embedutils.split_embed() to .send()
         :param files: list of files, passed straight to .send()
         """
-        async with database.db.execute("SELECT bulk_log_channel FROM server_config WHERE guild=?", (guildid,)) as cur:
-            modlogchannel = await cur.fetchone()
-        if modlogchannel is None or modlogchannel[0] is None:
+        modlogchannel = (await serverconfig.get(guildid)).bulk_log_channel
+        if modlogchannel is None:
             return
-        modlogchannel = modlogchannel[0]
         channel = await self.bot.fetch_channel(modlogchannel)
         await channel.send(embeds=embedutils.split_embed(embed), files=files)
 
@@ -1,11 +1,270 @@
+import asyncio
+import contextlib
+import functools
+import os
+import re
+import sqlite3
+import sys
+import time
 import typing
 
 import aiosqlite
+from aiosqlite.context import contextmanager
 
+from clogs import logger
+from perfstats import LatencyStats
+
+path = "database.sqlite"
+# how many read-only connections to keep open. each is its own thread so reads dont queue behind each other or writes
+reader_count = 4
+# group commit: writes that don't need to be durable right away get committed together after at most this many
+# seconds...
+commit_window = 0.25
+# ...or as soon as this many of them have piled up
+commit_batch_size = 200
+# statements slower than this many seconds (including time spent queued behind other statements) get logged
+slow_query_threshold = 0.25
+
+# the single writer connection. anything that changes the db (or needs to see its own uncommitted writes) uses this
 db: typing.Optional[aiosqlite.Connection] = None
+# pool of read-only connections, see read()
+readers: typing.Optional[asyncio.Queue] = None
+# the group commit currently collecting writes, see commit() and commit_later()
+_batch: typing.Optional[asyncio.Future] = None
+_batch_ready: typing.Optional[asyncio.Event] = None
+_batch_writes = 0
+# normalized sql -> timings, for every statement run through any of the connections
+querystats: dict[str, LatencyStats] = {}
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """collapse whitespace and literal numbers so the same statement with different f-string values counts once"""
+    return re.sub(r"\b\d+\b", "?", " ".join(sql.split()))
+
+
+def _call_site() -> str:
+    # the first frame that isn't this file or aiosqlite is whoever ran the query
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_code.co_filename == __file__
+                                 or f"{os.sep}aiosqlite{os.sep}" in frame.f_code.co_filename
+                                 or frame.f_code.co_filename.endswith("contextlib.py")):
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+def _record(sql: str, seconds: float):
+    sql = normalize_sql(sql)
+    if sql not in querystats:
+        querystats[sql] = LatencyStats()
+    querystats[sql].add(seconds)
+    if seconds >= slow_query_threshold:
+        logger.warning(f"slow query ({seconds * 1000:.1f}ms) from {_call_site()}: {sql}")
+
+
+class InstrumentedCursor(aiosqlite.Cursor):
+    """
+    cursor that keeps timing its statement while the rows are fetched. sqlite does most of a SELECT's work stepping
+    through rows, not in execute(), so the statement is only recorded once the rows run out or the cursor is closed.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection, cursor: sqlite3.Cursor, sql: str, elapsed: float):
+        super().__init__(conn, cursor)
+        self.sql = sql
+        self.elapsed = elapsed
+        self.recorded = False
+        # no result columns means it isn't a query, there's nothing left to fetch
+        if cursor.description is None:
+            self._finish()
+
+    def _finish(self):
+        if not self.recorded:
+            self.recorded = True
+            _record(self.sql, self.elapsed)
+
+    async def _timed(self, fn: typing.Callable[..., typing.Awaitable], *args):
+        start = time.perf_counter()
+        try:
+            return await fn(*args)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    async def fetchone(self) -> typing.Optional[sqlite3.Row]:
+        row = await self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        return row
+
+    async def fetchmany(self, size: typing.Optional[int] = None) -> typing.Iterable[sqlite3.Row]:
+        rows = await self._timed(super().fetchmany, size)
+        if not rows:
+            self._finish()
+        return rows
+
+    async def fetchall(self) -> typing.Iterable[sqlite3.Row]:
+        rows = await self._timed(super().fetchall)
+        self._finish()
+        return rows
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._finish()
+
+    def __del__(self):
+        # `cur = await db.execute(...)` then a single fetchone() never closes or runs out
+        self._finish()
+
+
+class InstrumentedConnection(aiosqlite.Connection):
+    """aiosqlite connection that times every way of running sql into querystats"""
+
+    @contextmanager
+    async def execute(self, sql: str, parameters: typing.Optional[typing.Iterable[typing.Any]] = None) \
+            -> InstrumentedCursor:
+        start = time.perf_counter()
+        try:
+            cursor = await self._execute(self._conn.execute, sql, [] if parameters is None else parameters)
+        except BaseException:
+            _record(sql, time.perf_counter() - start)
+            raise
+        return InstrumentedCursor(self, cursor, sql, time.perf_counter() - start)
+
+    @contextmanager
+    async def executemany(self, sql: str, parameters: typing.Iterable[typing.Iterable[typing.Any]]) \
+            -> aiosqlite.Cursor:
+        start = time.perf_counter()
+        try:
+            return await super().executemany(sql, parameters)
+        finally:
+            _record(sql, time.perf_counter() - start)
+
+    @contextmanager
+    async def execute_fetchall(self, sql: str, parameters: typing.Optional[typing.Iterable[typing.Any]] = None) \
+            -> typing.Iterable[sqlite3.Row]:
+        start = time.perf_counter()
+        try:
+            return await super().execute_fetchall(sql, parameters)
+        finally:
+            _record(sql, time.perf_counter() - start)
+
+    @contextmanager
+    async def execute_insert(self, sql: str, parameters: typing.Optional[typing.Iterable[typing.Any]] = None) \
+            -> typing.Optional[sqlite3.Row]:
+        start = time.perf_counter()
+        try:
+            return await super().execute_insert(sql, parameters)
+        finally:
+            _record(sql, time.perf_counter() - start)
+
+    @contextmanager
+    async def executescript(self, sql_script: str) -> aiosqlite.Cursor:
+        start = time.perf_counter()
+        try:
+            return await super().executescript(sql_script)
+        finally:
+            _record(sql_script, time.perf_counter() - start)
+
+
+async def connect(database: str, **kwargs) -> InstrumentedConnection:
+    """aiosqlite.connect() but instrumented"""
+    return await InstrumentedConnection(lambda: sqlite3.connect(database, **kwargs), 64)
 
 
 async def create_db():
-    global db
-    db = await aiosqlite.connect("database.sqlite")
+    global db, readers
+    db = await connect(path)
+    # WAL lets readers keep reading the last commit while the writer is mid-write. this setting sticks to the file.
+    async with db.execute("PRAGMA journal_mode=WAL") as cur:
+        await cur.fetchone()
+    readers = asyncio.Queue()
+    for _ in range(reader_count):
+        readers.put_nowait(await connect(f"file:{path}?mode=ro", uri=True))
     return db
+
+
+@contextlib.asynccontextmanager
+async def read(sql: str, parameters: typing.Optional[typing.Iterable[typing.Any]] = None) \
+        -> typing.AsyncIterator[aiosqlite.Cursor]:
+    """
+    run a SELECT on a pooled read-only connection, so it doesn't wait behind writes on the writer connection.
+    only sees committed data, use database.db for anything that has to see a write it just made.
+    usage is the same as db.execute(): `async with database.read("SELECT ...", (...)) as cur:`
+    the connection is out of the pool until the block ends, so get the rows and leave. don't await anything else
+    (discord api calls, writes, other reads) inside it, a handful of slow blocks stalls every read in the bot.
+    :param sql: the SELECT statement
+    :param parameters: parameters for the statement
+    :return: cursor for the results
+    """
+    con: aiosqlite.Connection = await readers.get()
+    try:
+        async with con.execute(sql, parameters) as cur:
+            yield cur
+    finally:
+        readers.put_nowait(con)
+
+
+async def _group_commit(batch: asyncio.Future, ready: asyncio.Event):
+    global _batch
+    try:
+        await asyncio.wait_for(ready.wait(), commit_window)
+    except asyncio.TimeoutError:
+        pass
+    # anything that asks for a commit from here on might land after this commit, so it gets the next batch
+    _batch = None
+    try:
+        await db.commit()
+    except Exception as e:
+        logger.error(e, exc_info=(type(e), e, e.__traceback__))
+        batch.set_exception(e)
+    else:
+        batch.set_result(None)
+
+
+def _join_batch() -> tuple[asyncio.Future, asyncio.Event]:
+    global _batch, _batch_ready, _batch_writes
+    if _batch is None:
+        _batch = asyncio.get_running_loop().create_future()
+        # fire and forget callers never look at the result, this stops asyncio complaining about it. the error
+        # still gets logged by _group_commit() and raised to anyone awaiting commit()
+        _batch.add_done_callback(lambda f: f.exception())
+        _batch_ready = asyncio.Event()
+        _batch_writes = 0
+        asyncio.create_task(_group_commit(_batch, _batch_ready))
+    return _batch, _batch_ready
+
+
+def commit_later():
+    """
+    commit writes made on the writer connection eventually, without waiting.
+    for hot paths where losing the last fraction of a second of writes to a crash is fine.
+    """
+    global _batch_writes
+    batch, ready = _join_batch()
+    _batch_writes += 1
+    if _batch_writes >= commit_batch_size:
+        ready.set()
+
+
+async def commit():
+    """
+    commit writes made on the writer connection and wait until they're on disk.
+    drop-in for db.commit(), but flushes everything commit_later() has queued up in the same commit.
+    """
+    batch, ready = _join_batch()
+    ready.set()
+    # shielded so a cancelled caller doesn't cancel the commit for everyone else in the batch
+    await asyncio.shield(batch)
+
+
+async def close():
+    """flush pending writes then close every reader and the writer"""
+    if _batch is not None:
+        await commit()
+    await db.commit()
+    while not readers.empty():
+        await readers.get_nowait().close()
+    await db.close()
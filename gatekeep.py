@@ -6,6 +6,7 @@ from discord.ext import commands
 
 import database
 import modlog
+import serverconfig
 from clogs import logger
 from moderation import update_server_config, mod_only
 
@@ -29,7 +30,7 @@ class GateKeep(commands.Cog):
     #             await th.edit(archived=True, locked=True)
     #             await database.db.execute("DELETE FROM members_to_verify guild=? AND member=?",
     #                                       (member.guild.id, member.id))
-    #             await database.db.commit()
+    #             await database.commit()
 
     async def omr(self, memberid: int, memberguild: discord.Guild):
         async with database.db.execute("SELECT thread FROM members_to_verify WHERE guild=? AND member=?",
@@ -50,7 +51,7 @@ class GateKeep(commands.Cog):
                         await th.edit(archived=True, locked=True)
         await database.db.execute("DELETE FROM members_to_verify WHERE guild=? AND member=?",
                                   (memberguild.id, memberid))
-        await database.db.commit()
+        await database.commit()
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
@@ -62,11 +63,9 @@ class GateKeep(commands.Cog):
         if member.guild.id == 829973626442088468:  # hos
             await member.remove_roles(*[role for role in member.roles if role.is_assignable()],
                                       atomic=False)  # remove roles
-        async with database.db.execute(
-                "SELECT verification_channel,mod_role,verified_role,verification_text FROM server_config WHERE guild=?",
-                (member.guild.id,)) as cur:
-            res = await cur.fetchone()
-        if res and res[0]:
+        conf = await serverconfig.get(member.guild.id)
+        res = conf.verification_channel, conf.mod_role, conf.verified_role, conf.verification_text
+        if res[0]:
             if "PRIVATE_THREADS" in member.guild.features:
                 # create thread
                 thread = await member.guild.get_channel(res[0]) \
@@ -87,7 +86,7 @@ class GateKeep(commands.Cog):
                 # add to db
             await database.db.execute("REPLACE INTO members_to_verify (guild, member, thread) VALUES (?,?,?)",
                                       (member.guild.id, member.id, thread.id))
-            await database.db.commit()
+            await database.commit()
             # add mods and user to thread
             if res[1]:
                 modping = member.guild.get_role(res[1]).mention
@@ -130,17 +129,14 @@ class GateKeep(commands.Cog):
         async with ctx.typing():
 
             # get or create role
-            async with database.db.execute(
-                    "SELECT verified_role,verification_channel,mod_role from server_config WHERE guild=?",
-                    (ctx.guild.id,)) as cur:
-                res = await cur.fetchone()
+            conf = await serverconfig.get(ctx.guild.id)
+            res = conf.verified_role, conf.verification_channel, conf.mod_role
             # action only needs to be taken if role does not exist
-            if not (res and res[0] and (verified_role := ctx.guild.get_role(res[0]))):
+            if not (res[0] and (verified_role := ctx.guild.get_role(res[0]))):
                 verified_role = await ctx.guild.create_role(name="[MelUtils] Verified",
                                                             permissions=discord.Permissions(view_channel=True))
-                await database.db.execute("UPDATE server_config SET verified_role=? WHERE guild=?",
-                                          (verified_role.id, ctx.guild.id))
-            if res and res[2]:
+                await update_server_config(ctx.guild.id, "verified_role", verified_role.id)
+            if res[2]:
                 mod_role = ctx.guild.get_role(res[2])
             else:
                 mod_role = None
@@ -151,17 +147,14 @@ class GateKeep(commands.Cog):
             }
             if mod_role:
                 ovrs[mod_role] = discord.PermissionOverwrite(view_channel=True)
-            if not (res and res[1] and (verify_channel := ctx.guild.get_channel(res[1]))):
+            if not (res[1] and (verify_channel := ctx.guild.get_channel(res[1]))):
                 verify_channel = await ctx.guild.create_text_channel("melutils-verification", overwrites=ovrs)
-                await database.db.execute("UPDATE server_config SET verification_channel=? WHERE guild=?",
-                                          (verify_channel.id, ctx.guild.id))
+                await update_server_config(ctx.guild.id, "verification_channel", verify_channel.id)
             else:  # channel exists
                 # update its overwrites properly
                 verify_channel.overwrites.update(ovrs)
                 await verify_channel.edit(overwrites=verify_channel.overwrites)
 
-            await database.db.commit()
-
             # give verified role to all members
             v_actions = [m.add_roles(verified_role) for m in ctx.guild.members if verified_role not in m.roles]
             await asyncio.gather(*v_actions, return_exceptions=True)
@@ -220,12 +213,10 @@ class GateKeep(commands.Cog):
         # if we can find the relevant member for the channel
         if res and res[0]:
             member = ctx.guild.get_member(res[0])
-            async with database.db.execute("SELECT verified_role FROM server_config WHERE guild=?",
-                                           (ctx.guild.id,)) as cur:
-                res2 = await cur.fetchone()
+            verified_role = (await serverconfig.get(ctx.guild.id)).verified_role
             # if we can get the guild's verifed role, add it and
-            if res2 and res2[0]:
-                role = ctx.guild.get_role(res2[0])
+            if verified_role:
+                role = ctx.guild.get_role(verified_role)
                 await ctx.send(f"{member.mention} has been verified.")
                 await member.add_roles(role)
                 # lock thread, hide from user cause lol?
@@ -235,7 +226,7 @@ class GateKeep(commands.Cog):
                                     ctx.guild.id, member.id, ctx.author.id)
                 await database.db.execute("DELETE FROM members_to_verify WHERE guild=? AND member=?",
                                           (ctx.guild.id, member.id))
-                await database.db.commit()
+                await database.commit()
             else:
                 await ctx.reply("❌ Server has no verified role. Run `m.initverification` to create one.")
         else:
@@ -254,10 +245,7 @@ class GateKeep(commands.Cog):
                     (ctx.guild.id,)) as cur:
                 cur: aiosqlite.Cursor
                 saved_members = await cur.fetchall()
-            async with database.db.execute("SELECT verified_role FROM server_config WHERE guild=?",
-                                           (ctx.guild.id,)) as cur:
-                res2 = await cur.fetchone()
-            verified_role = ctx.guild.get_role(res2[0])
+            verified_role = ctx.guild.get_role((await serverconfig.get(ctx.guild.id)).verified_role)
             members = list(ctx.guild.members)
             for member in members:
                 for vmember, vthread in saved_members:
@@ -271,7 +259,7 @@ class GateKeep(commands.Cog):
                             else:
                                 await database.db.execute("DELETE FROM members_to_verify WHERE guild=? AND member=?",
                                                           (ctx.guild.id, member.id))
-                                await database.db.commit()
+                                await database.commit()
                         except discord.DiscordException:
                             if verified_role not in member.roles and not member.bot:
                                 # member in db, but thread is gone. run first-time setup
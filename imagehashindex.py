@@ -0,0 +1,218 @@
+import asyncio
+import typing
+
+import numpy as np
+
+import database
+
+# a channel's index gets rebuilt without its deleted hashes once there are more of them than live ones, and at least
+# this many
+rebuild_min_tombstones = 1024
+# searches with a hashdiff up to this walk the BK-tree, anything looser scans every hash with numpy instead. the tree
+# only prunes well when the radius is tiny compared to the hash, at 64 bits a scan of 100k hashes is ~0.2ms while the
+# tree already takes ~9ms at hashdiff 4
+tree_max_hashdiff = 1
+
+
+class ImageHashEntry(typing.NamedTuple):
+    """one row of imageset_hashes, minus what the index already knows"""
+    message: int
+    att_url: str
+    image_width: int
+    image_height: int
+
+
+class _Node:
+    __slots__ = ("hash", "entries", "children")
+
+    def __init__(self, imhash: int, entry: ImageHashEntry):
+        self.hash = imhash
+        # every image with exactly this hash
+        self.entries = [entry]
+        # hamming distance from this node -> child
+        self.children: dict[int, _Node] = {}
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def hash_bytes(imhash: int, hashsize: int) -> bytes:
+    """
+    how a hash is stored in imageset_hashes.hash
+    :param imhash: the phash bits as an int
+    :param hashsize: the hashsize it was made with, it's hashsize² bits
+    :return: the bits, big endian, in as few bytes as fit them
+    """
+    return imhash.to_bytes((hashsize * hashsize + 7) // 8, "big")
+
+
+def _words(imhash: int, words: int) -> list[int]:
+    # split into 64 bit chunks for a uint64 array row, least significant first
+    return [(imhash >> (64 * i)) & 0xFFFFFFFFFFFFFFFF for i in range(words)]
+
+
+class HashIndex:
+    """
+    every image hash in one Image Set channel, indexed two ways:
+    a BK-tree, so finding the hashes within a small `hashdiff` of a new one only visits the branches that can hold
+    them. with hashdiff 0 (the default) that's a walk down one path.
+    a uint64 array with a row per hash (more than one word per row for hashsize over 8), so a looser hashdiff is one
+    vectorized xor and popcount over the whole channel instead of a tree walk that ends up visiting most of it.
+    hashes are the phash bits as an int. deleting just tombstones the entry since a BK-tree can't unlink a node, and
+    both get rebuilt when they pile up.
+    """
+
+    def __init__(self, hashsize: int, rows: typing.Iterable[tuple[int, ImageHashEntry]] = ()):
+        self.hashsize = hashsize
+        self.root: typing.Optional[_Node] = None
+        # att_url -> live entry. anything in the tree that isn't in here is a tombstone
+        self.entries: dict[str, ImageHashEntry] = {}
+        self.hashes: dict[str, int] = {}
+        self.by_message: dict[int, set[str]] = {}
+        self.tombstones = 0
+        # the array side. row i of matrix is rows[i], and is a tombstone if live[i] is false. rows past len(rows) are
+        # spare capacity
+        self.rows: list[ImageHashEntry] = []
+        self.row_of: dict[str, int] = {}
+        self.matrix = np.zeros((64, (hashsize * hashsize + 63) // 64), dtype=np.uint64)
+        self.live = np.zeros(64, dtype=bool)
+        for imhash, entry in rows:
+            self.add(imhash, entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, imhash: int, entry: ImageHashEntry):
+        # att_url is the primary key and inserts of an existing one are ignored, same here
+        if entry.att_url in self.entries:
+            return
+        self.entries[entry.att_url] = entry
+        self.hashes[entry.att_url] = imhash
+        self.by_message.setdefault(entry.message, set()).add(entry.att_url)
+        row = len(self.rows)
+        if row == len(self.matrix):
+            self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+            self.live = np.concatenate([self.live, np.zeros_like(self.live)])
+        self.matrix[row] = _words(imhash, self.matrix.shape[1])
+        self.live[row] = True
+        self.rows.append(entry)
+        self.row_of[entry.att_url] = row
+        if self.root is None:
+            self.root = _Node(imhash, entry)
+            return
+        node = self.root
+        while True:
+            distance = hamming(imhash, node.hash)
+            if distance == 0:
+                node.entries.append(entry)
+                return
+            child = node.children.get(distance)
+            if child is None:
+                node.children[distance] = _Node(imhash, entry)
+                return
+            node = child
+
+    def remove_message(self, message: int):
+        """forget every image from a message"""
+        for att_url in self.by_message.pop(message, ()):
+            del self.entries[att_url]
+            del self.hashes[att_url]
+            self.live[self.row_of.pop(att_url)] = False
+            self.tombstones += 1
+        if self.tombstones >= rebuild_min_tombstones and self.tombstones > len(self.entries):
+            self.rebuild()
+
+    def rebuild(self):
+        """build the tree again from just the live entries"""
+        live = [(self.hashes[att_url], entry) for att_url, entry in self.entries.items()]
+        self.__init__(self.hashsize, live)
+
+    def search(self, imhash: int, maxdistance: int) -> list[tuple[int, ImageHashEntry]]:
+        """
+        :param imhash: hash to look for
+        :param maxdistance: furthest hamming distance that still counts
+        :return: (distance, entry) of every live image within maxdistance, closest first then oldest message first
+        """
+        if maxdistance > tree_max_hashdiff:
+            return self.scan(imhash, maxdistance)
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(imhash, node.hash)
+            if distance <= maxdistance:
+                found.extend((distance, entry) for entry in node.entries if self.entries.get(entry.att_url) is entry)
+            # triangle inequality: a hash within maxdistance of imhash is between distance - maxdistance and
+            # distance + maxdistance away from this node, so only the children in that range can lead to one
+            for childdistance, child in node.children.items():
+                if distance - maxdistance <= childdistance <= distance + maxdistance:
+                    stack.append(child)
+        found.sort(key=lambda match: (match[0], match[1].message))
+        return found
+
+    def scan(self, imhash: int, maxdistance: int) -> list[tuple[int, ImageHashEntry]]:
+        """search() by comparing against every hash at once instead of walking the tree. same results."""
+        count = len(self.rows)
+        query = np.array(_words(imhash, self.matrix.shape[1]), dtype=np.uint64)
+        distances = np.bitwise_count(self.matrix[:count] ^ query).sum(axis=1, dtype=np.int64)
+        matches = np.flatnonzero((distances <= maxdistance) & self.live[:count])
+        found = [(int(distances[row]), self.rows[row]) for row in matches]
+        found.sort(key=lambda match: (match[0], match[1].message))
+        return found
+
+
+# channel id -> index, built on first use
+indexes: dict[int, HashIndex] = {}
+_loading: dict[int, asyncio.Future] = {}
+
+
+async def get(channel: int, hashsize: int) -> HashIndex:
+    """
+    get a channel's HashIndex, building it from the db if it isn't cached
+    :param channel: channel id
+    :param hashsize: the channel's hashsize
+    :return: the index
+    """
+    index = indexes.get(channel)
+    if index is not None:
+        return index
+    if channel in _loading:
+        return await asyncio.shield(_loading[channel])
+    _loading[channel] = asyncio.get_running_loop().create_future()
+    # if nobody else was waiting on it, don't complain that nobody saw the error
+    _loading[channel].add_done_callback(lambda f: f.exception())
+    try:
+        # on the writer connection in one call, so every write made before this is in the rows and every write made
+        # after it gets to added() and removed() after the index is cached
+        rows = await database.db.execute_fetchall(
+            "SELECT hash, message, att_url, image_width, image_height FROM imageset_hashes WHERE channel=?",
+            (channel,))
+        index = HashIndex(hashsize, ((int.from_bytes(imhash, "big"),
+                                      ImageHashEntry(message, att_url, width, height))
+                                     for imhash, message, att_url, width, height in rows))
+        indexes[channel] = index
+        _loading.pop(channel).set_result(index)
+        return index
+    except BaseException as e:
+        _loading.pop(channel).set_exception(e)
+        raise
+
+
+def added(channel: int, imhash: int, entry: ImageHashEntry):
+    """keep a cached index up to date after a hash is inserted into imageset_hashes"""
+    index = indexes.get(channel)
+    if index is not None:
+        index.add(imhash, entry)
+
+
+def removed(channel: int, message: int):
+    """keep a cached index up to date after a message's hashes are deleted from imageset_hashes"""
+    index = indexes.get(channel)
+    if index is not None:
+        index.remove_message(message)
+
+
+def drop(channel: int):
+    """forget a channel's index, for when it stops being an Image Set or its settings change"""
+    indexes.pop(channel, None)
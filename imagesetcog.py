@@ -1,5 +1,9 @@
 import asyncio
+import collections
+import concurrent.futures
+import dataclasses
 import io
+import multiprocessing
 import typing
 
 import aiohttp
@@ -9,28 +13,134 @@ from PIL import Image
 from discord.ext import commands
 
 import database
+import imagehashindex
 import moderation
 from clogs import logger
 
 
-async def saveurl(url) -> bytes:
+async def saveurl(url, session: typing.Optional[aiohttp.ClientSession] = None) -> bytes:
     """
     save a url to bytes
     :param url: web url of a file
+    :param session: session to download with, so lots of downloads can share connections. a new one if None
     :return: bytes of result
     """
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                return await resp.read()
-            else:
-                resp.raise_for_status()
+    if session is None:
+        async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
+            return await saveurl(url, session)
+    async with session.get(url) as resp:
+        if resp.status == 200:
+            return await resp.read()
+        else:
+            resp.raise_for_status()
+
+
+# how many processes decode and hash images, so big images don't block the event loop
+hash_workers = 4
+# how many images one guild can have in the hash workers at once, so one guild rescanning or bulk uploading can't
+# make everyone else wait behind it...
+hash_guild_limit = 2
+# ...and how many more scanned images can wait for a turn. past that the scan holds its watermark there and the next
+# rescanimagesets picks them up. new messages always wait their turn, nothing else would come back for them
+hash_guild_queue_limit = 32
+
+_hash_pool: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+
+class HashQueueFull(Exception):
+    """a guild already has hash_guild_queue_limit images waiting to be hashed"""
+
+
+class _GuildSlots:
+    """one guild's share of the hash workers"""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(hash_guild_limit)
+        # images running or waiting
+        self.queued = 0
+
 
+# guild id -> its slots, only while it has images running or waiting
+_guild_slots: dict[int, _GuildSlots] = {}
 
-async def hashandresurl(url, size: int) -> typing.Tuple[imagehash.ImageHash, typing.Tuple[int, int]] | None:
+
+def hashbytes(data: bytes, size: int) -> typing.Tuple[str, typing.Tuple[int, int]]:
+    """
+    runs in a hash worker process. only the file and the result cross over, no PIL objects.
+    :param data: the image file
+    :param size: hash size
+    :return: (hex of the phash, (width, height))
+    """
+    im = Image.open(io.BytesIO(data))
+    return str(imagehash.phash(im, size)), im.size
+
+
+def hash_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        # not fork, by now the bot has the db connection threads running and a forked child can deadlock on a lock
+        # one of them held. forkserver forks workers from a clean single threaded process instead
+        _hash_pool = concurrent.futures.ProcessPoolExecutor(hash_workers,
+                                                             mp_context=multiprocessing.get_context("forkserver"))
+    return _hash_pool
+
+
+def shutdown_hash_pool(wait: bool = True):
+    """
+    stop the hash workers, anything still queued for them is cancelled
+    :param wait: wait for the images being hashed right now to finish, otherwise they're left to exit on their own
+    """
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=wait, cancel_futures=True)
+        _hash_pool = None
+
+
+async def hashdata(data: bytes, size: int, guild: int, wait: bool = False) \
+        -> typing.Tuple[str, typing.Tuple[int, int]]:
+    """
+    hash an image in the hash workers
+    :param data: the image file
+    :param size: hash size
+    :param guild: guild id, for hash_guild_limit and hash_guild_queue_limit
+    :param wait: wait for a turn however many images are queued, instead of raising HashQueueFull. it still counts
+        towards the queue, so scans back off while new messages are waiting
+    :return: (hex of the phash, (width, height))
+    :raises HashQueueFull: if the guild has too many images waiting already and wait is false
+    """
+    slots = _guild_slots.get(guild)
+    if slots is None:
+        slots = _guild_slots[guild] = _GuildSlots()
+    if not wait and slots.queued >= hash_guild_limit + hash_guild_queue_limit:
+        raise HashQueueFull(f"guild {guild} has {slots.queued} images waiting to be hashed")
+    slots.queued += 1
     try:
-        im = Image.open(io.BytesIO(await saveurl(url)))
-        return imagehash.phash(im, size), im.size
+        async with slots.semaphore:
+            try:
+                return await asyncio.get_running_loop().run_in_executor(hash_pool(), hashbytes, data, size)
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died (probably out of memory on a huge image) and took the pool with it, start fresh ones
+                # next time
+                logger.warning("hash worker died, restarting the pool")
+                shutdown_hash_pool(wait=False)
+                raise
+    finally:
+        slots.queued -= 1
+        # idle guilds don't keep their slots around
+        if not slots.queued:
+            del _guild_slots[guild]
+
+
+async def hashandresurl(url, size: int, guild: int) -> typing.Tuple[str, typing.Tuple[int, int]] | None:
+    """
+    download and hash an image
+    :param url: url of the image
+    :param size: hash size
+    :param guild: guild id, for hash_guild_limit
+    :return: (hex of the phash, (width, height)), None if it couldn't be downloaded or isn't an image
+    """
+    try:
+        return await hashdata(await saveurl(url), size, guild, wait=True)
     except Exception as e:
         logger.debug(f"hashing {url} failed due to {e}")
 
@@ -70,6 +180,46 @@ dup_funcs = {
 }
 
 
+async def find_duplicate(message: discord.Message, att_url: str, imhash: str, imres: typing.Tuple[int, int],
+                         index: imagehashindex.HashIndex, hashdiff: int, duplicate_behavior: str):
+    """
+    look for an earlier copy of an image and do the channel's duplicate behavior if there is one
+    :param message: the message the image is from
+    :param att_url: url of the image
+    :param imhash: hex of the image's hash
+    :param imres: (width, height) of the image
+    :param index: the channel's HashIndex
+    :param hashdiff: the channel's hashdiff
+    :param duplicate_behavior: the channel's duplicate_behavior
+    """
+    for diff, prev in index.search(int(imhash, 16), hashdiff):  # omg a match!!!!
+        # only do anything if the message still exists
+        try:
+            prevmessage = await message.channel.fetch_message(prev.message)
+        except discord.NotFound:
+            # message was deleted so byeeeeeeeeeee
+            await database.db.execute("DELETE FROM imageset_hashes WHERE message=?", (prev.message,))
+            await database.commit()
+            imagehashindex.removed(message.channel.id, prev.message)
+        else:
+            logger.debug(f"hash for {message.jump_url} ({imhash}) matches hash for {prevmessage.jump_url} by {diff}")
+            # do user defined behavior
+            await dup_funcs[duplicate_behavior](message, att_url, imres, prevmessage, prev.att_url,
+                                                (prev.image_width, prev.image_height))
+            break  # doing it multiple times is silly
+
+
+def hashrow(message: discord.Message, att_url: str, imhash: str, imres: typing.Tuple[int, int], hashsize: int) \
+        -> tuple:
+    """the imageset_hashes row for an image, in the order of insert_hashes_sql"""
+    return (message.guild.id, message.channel.id, message.id, message.jump_url, att_url,
+            imagehashindex.hash_bytes(int(imhash, 16), hashsize), imres[0], imres[1])
+
+
+insert_hashes_sql = "INSERT INTO imageset_hashes(guild, channel, message, message_url, att_url, hash, image_width, " \
+                    "image_height) VALUES (?,?,?,?,?,?,?,?)"
+
+
 async def hashmessage(message: discord.Message, react=True):
     if message.attachments:
         if react:
@@ -78,51 +228,248 @@ async def hashmessage(message: discord.Message, react=True):
                 "SELECT hashsize, hashdiff, duplicate_behavior FROM imageset_channels WHERE channel=?",
                 (message.channel.id,)) as cur:
             (hashsize, hashdiff, duplicate_behavior) = await cur.fetchone()
+        index = await imagehashindex.get(message.channel.id, hashsize)
         for att in message.attachments:
-            async with database.db.execute("SELECT 1 FROM imageset_hashes WHERE att_url=?",
-                                           (att.url.split("?")[0],)) as cur:
-                exists = await cur.fetchone() is not None
-            if not exists:
-                hashresult = await hashandresurl(att.url, hashsize)
+            # the index has every hashed attachment in the channel
+            if att.url.split("?")[0] not in index.entries:
+                hashresult = await hashandresurl(att.url, hashsize, message.guild.id)
                 if hashresult:
                     imhash, imres = hashresult
                     logger.debug(f"hash for {att.url} of {message.jump_url} is {imhash}")
-                    async with database.db.execute("SELECT hash, message, att_url, image_width, image_height FROM "
-                                                   "imageset_hashes WHERE channel=?",
-                                                   (message.channel.id,)) as cursor:
-                        async for (prevhash, prevmessage, att_url, old_w, old_h) in cursor:
-                            if (diff := imagehash.hex_to_hash(prevhash) - imhash) <= hashdiff:  # omg a match!!!!
-
-                                # only do anything if the message still exists
-                                try:
-                                    prevmessage = await message.channel.fetch_message(prevmessage)
-                                except discord.NotFound:
-                                    # message was deleted so byeeeeeeeeeee
-                                    await database.db.execute("DELETE FROM imageset_hashes WHERE message=?",
-                                                              (prevmessage,))
-                                    await database.db.commit()
-                                else:
-                                    logger.debug(f"hash for {message.jump_url} ({imhash}) matches hash for "
-                                                 f"{prevmessage.jump_url} ({prevhash}) by {diff}")
-                                    # do user defined behavior
-                                    await dup_funcs[duplicate_behavior](message, att.url, imres, prevmessage, att_url,
-                                                                        (old_w, old_h))
-                                    break  # doing it multiple times is silly
-
+                    await find_duplicate(message, att.url, imhash, imres, index, hashdiff, duplicate_behavior)
                     if duplicate_behavior != "delete":
-                        await database.db.execute(
-                            "INSERT INTO imageset_hashes(guild, channel, message, message_url, att_url, hash,"
-                            " image_width, image_height) VALUES (?,?,?,?,?,?,?,?)",
-                            (message.guild.id, message.channel.id, message.id, message.jump_url, att.url.split("?")[0],
-                             str(imhash), imres[0], imres[1]))
-                        await database.db.commit()
+                        await database.db.execute(insert_hashes_sql,
+                                                  hashrow(message, att.url.split("?")[0], imhash, imres, hashsize))
+                        await database.commit()
+                        imagehashindex.added(message.channel.id, int(imhash, 16),
+                                             imagehashindex.ImageHashEntry(message.id, att.url.split("?")[0],
+                                                                           imres[0], imres[1]))
         if react:
             await message.remove_reaction("⚙", message.guild.me)
 
 
-async def hashchannel(channel: typing.Union[discord.TextChannel, discord.Thread]):
-    async for message in channel.history(limit=None, oldest_first=True):
-        await hashmessage(message, False)
+# hashchannel is a pipeline: one task reads history, scan_downloaders download attachments, hash_guild_limit tasks
+# hash them (it's the most a guild can hash at once anyway), and one task checks for duplicates and writes hashes in
+# batches. each stage hands off through a queue of scan_queue_size, so a slow stage makes the ones before it wait
+scan_downloaders = 8
+scan_queue_size = 32
+# most attachments between being read and being written. the writer goes in history order (so the newer copy is the
+# one that counts as the duplicate) and this is how far ahead of it everything else can get
+scan_window = 256
+# most hashes per executemany
+scan_write_batch = 100
+# how many channels rescanimagesets does at once
+rescan_concurrency = 2
+# how often to update the progress message, in seconds
+scan_progress_interval = 5
+
+
+@dataclasses.dataclass
+class ScanStatus:
+    """how far a hashchannel (and prunechannel) has gotten"""
+    channel: typing.Union[discord.TextChannel, discord.Thread]
+    messages: int = 0
+    images: int = 0
+    hashed: int = 0
+    pruned: typing.Optional[int] = None
+    # images that couldn't be downloaded or hashed this time, the next scan tries them again
+    retry: int = 0
+    done: bool = False
+
+    def __str__(self):
+        pruned = "" if self.pruned is None else f", {self.pruned:,} deleted messages forgotten"
+        retry = f", {self.retry:,} failed and will be retried next scan" if self.retry else ""
+        return f"{self.channel.mention}: {'done, ' if self.done else ''}{self.messages:,} messages read, " \
+               f"{self.hashed:,}/{self.images:,} new images hashed{pruned}{retry}"
+
+
+async def prunechannel(channel: typing.Union[discord.TextChannel, discord.Thread],
+                       status: typing.Optional[ScanStatus] = None):
+    """
+    forget the hashes of messages that were deleted while nobody was looking. doesn't hash anything, the messages
+    after the channel's last_message are hashchannel's job.
+    :param channel: Image Set channel
+    :param status: updated as the scan goes, for progress messages
+    """
+    if status is None:
+        status = ScanStatus(channel)
+    status.pruned = 0
+    async with database.db.execute("SELECT DISTINCT message FROM imageset_hashes WHERE channel=?",
+                                   (channel.id,)) as cur:
+        missing = {message for (message,) in await cur.fetchall()}
+    if missing:
+        # newest first, since the oldest hashed message is as far back as it needs to go
+        oldest = min(missing)
+        async for message in channel.history(limit=None, after=discord.Object(oldest - 1), oldest_first=False):
+            status.messages += 1
+            missing.discard(message.id)
+            if not missing:
+                break
+    await database.db.executemany("DELETE FROM imageset_hashes WHERE message=?", [(message,) for message in missing])
+    await database.commit()
+    for message in missing:
+        imagehashindex.removed(channel.id, message)
+    status.pruned = len(missing)
+
+
+async def hashchannel(channel: typing.Union[discord.TextChannel, discord.Thread],
+                      status: typing.Optional[ScanStatus] = None):
+    """
+    hash every image in a channel that isn't hashed yet, doing the channel's duplicate behavior on any duplicates.
+    starts after the channel's last_message, and moves last_message up as it goes.
+    :param channel: Image Set channel
+    :param status: updated as the scan goes, for progress messages
+    """
+    if status is None:
+        status = ScanStatus(channel)
+    async with database.db.execute(
+            "SELECT hashsize, hashdiff, duplicate_behavior, last_message FROM imageset_channels WHERE channel=?",
+            (channel.id,)) as cur:
+        (hashsize, hashdiff, duplicate_behavior, last_message) = await cur.fetchone()
+    index = await imagehashindex.get(channel.id, hashsize)
+    # items are (sequence number, message, attachment url, then the file or the hash result), None is the end
+    download_queue = asyncio.Queue(scan_queue_size)
+    hash_queue = asyncio.Queue(scan_queue_size)
+    write_queue = asyncio.Queue(scan_queue_size)
+    window = asyncio.Semaphore(scan_window)
+    hashers = hash_guild_limit
+    # how many of each stage are still running, the last one out tells the next stage
+    running = {"download": scan_downloaders, "hash": hashers}
+    # stands in for a download or hash that failed but could work next time
+    failed = object()
+    # (sequence number, message id): once everything before that sequence number is written, that message and
+    # everything before it is done. only ever moved by scans, on_message doesn't see messages sent while offline
+    done_at: collections.deque[tuple[int, int]] = collections.deque()
+
+    async def read():
+        sequence = 0
+        after = discord.Object(last_message) if last_message is not None else None
+        async for message in channel.history(limit=None, after=after, oldest_first=True):
+            status.messages += 1
+            for att in message.attachments:
+                if att.url.split("?")[0] not in index.entries:
+                    await window.acquire()
+                    status.images += 1
+                    await download_queue.put((sequence, message, att.url))
+                    sequence += 1
+            if done_at and done_at[-1][0] == sequence:
+                done_at[-1] = (sequence, message.id)
+            else:
+                done_at.append((sequence, message.id))
+        for _ in range(scan_downloaders):
+            await download_queue.put(None)
+
+    async def download(session: aiohttp.ClientSession):
+        while (item := await download_queue.get()) is not None:
+            sequence, message, url = item
+            try:
+                data = await saveurl(url, session)
+            except aiohttp.ClientResponseError as e:
+                logger.debug(f"downloading {url} failed due to {e}")
+                # the attachment is gone for good, anything else is worth another try
+                data = None if e.status in (403, 404) else failed
+            except Exception as e:
+                logger.debug(f"downloading {url} failed due to {e}")
+                data = failed
+            await hash_queue.put((sequence, message, url, data))
+        running["download"] -= 1
+        if not running["download"]:
+            for _ in range(hashers):
+                await hash_queue.put(None)
+
+    async def hash_():
+        while (item := await hash_queue.get()) is not None:
+            sequence, message, url, data = item
+            result = None if data is None else failed
+            if data is not None and data is not failed:
+                try:
+                    result = await hashdata(data, hashsize, channel.guild.id)
+                except (HashQueueFull, concurrent.futures.process.BrokenProcessPool) as e:
+                    logger.debug(f"hashing {url} failed due to {e}")
+                except Exception as e:
+                    # not an image, it won't be one next time either
+                    logger.debug(f"hashing {url} failed due to {e}")
+                    result = None
+            status.hashed += 1
+            await write_queue.put((sequence, message, url, result))
+        running["hash"] -= 1
+        if not running["hash"]:
+            await write_queue.put(None)
+
+    async def flush(rows: list, written_to: int):
+        # written_to: everything before this sequence number is written or never needs to be
+        watermark = None
+        while done_at and done_at[0][0] <= written_to:
+            watermark = done_at.popleft()[1]
+        await database.db.executemany(insert_hashes_sql, rows)
+        if watermark is not None:
+            await database.db.execute("UPDATE imageset_channels SET last_message=? WHERE channel=?",
+                                      (watermark, channel.id))
+        await database.commit()
+
+    async def write():
+        try:
+            await write_batches()
+        except BaseException:
+            # hashes go into the index before they're written, so it has some the db never got
+            imagehashindex.drop(channel.id)
+            raise
+
+    async def write_batches():
+        # results come in whatever order they finish, this holds them until it's their turn
+        waiting: dict[int, tuple] = {}
+        next_sequence = 0
+        # the first image that failed in a way worth retrying. the watermark stays before it so the next scan does
+        retry_from = None
+        rows = []
+        while (item := await write_queue.get()) is not None:
+            waiting[item[0]] = item
+            while next_sequence in waiting:
+                _, message, url, result = waiting.pop(next_sequence)
+                window.release()
+                if result is failed:
+                    status.retry += 1
+                    if retry_from is None:
+                        retry_from = next_sequence
+                next_sequence += 1
+                att_url = url.split("?")[0]
+                # on_message might have gotten to it while it was in the pipeline
+                if result is None or result is failed or att_url in index.entries:
+                    continue
+                imhash, imres = result
+                await find_duplicate(message, url, imhash, imres, index, hashdiff, duplicate_behavior)
+                if duplicate_behavior != "delete":
+                    rows.append(hashrow(message, att_url, imhash, imres, hashsize))
+                    # into the index right away so the rest of the batch gets checked against it
+                    imagehashindex.added(channel.id, int(imhash, 16),
+                                         imagehashindex.ImageHashEntry(message.id, att_url, imres[0], imres[1]))
+            if len(rows) >= scan_write_batch or (rows and write_queue.empty()):
+                await flush(rows, next_sequence if retry_from is None else retry_from)
+                rows = []
+        # the reader is done by now, so unless something failed this is the watermark for the whole channel
+        await flush(rows, next_sequence if retry_from is None else retry_from)
+
+    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
+        tasks = [asyncio.create_task(read()), asyncio.create_task(write())]
+        tasks += [asyncio.create_task(download(session)) for _ in range(scan_downloaders)]
+        tasks += [asyncio.create_task(hash_()) for _ in range(hashers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # if one stage failed, the rest would wait on it forever
+            for task in tasks:
+                task.cancel()
+    status.done = True
+
+
+async def report_scan(msg: discord.Message, title: str, statuses: list[ScanStatus]):
+    """keep editing a message with the progress of some hashchannels, until cancelled"""
+    while True:
+        await asyncio.sleep(scan_progress_interval)
+        try:
+            await msg.edit(content="\n".join([title] + [str(status) for status in statuses]))
+        except discord.HTTPException:
+            pass
 
 
 async def callback(*args, **kwargs):
@@ -158,13 +505,18 @@ class ImageSetCog(commands.Cog):
     def __init__(self, bot):
         self.bot: commands.Bot = bot
 
+    async def cog_unload(self):
+        # waits for the images being hashed right now, off the event loop
+        await asyncio.to_thread(shutdown_hash_pool)
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        async with database.db.execute(
+        async with database.read(
                 "SELECT 1 FROM imageset_channels WHERE channel=?",
                 (message.channel.id,)) as cur:
-            if await cur.fetchone():
-                await hashmessage(message)
+            isimageset = await cur.fetchone()
+        if isimageset:
+            await hashmessage(message)
 
     @moderation.mod_only()
     @commands.command()
@@ -189,16 +541,26 @@ class ImageSetCog(commands.Cog):
                                        (channel.id, channel.guild.id)) as cur:
             exists = await cur.fetchone() is not None
 
-        await database.db.execute("REPLACE INTO imageset_channels(guild, channel, hashsize, hashdiff, "
-                                  "duplicate_behavior) VALUES (?,?,?,?,?)",
+        # not REPLACE, that would throw away last_message
+        await database.db.execute("INSERT INTO imageset_channels(guild, channel, hashsize, hashdiff, "
+                                  "duplicate_behavior) VALUES (?,?,?,?,?) ON CONFLICT(guild, channel) DO UPDATE SET "
+                                  "hashsize=excluded.hashsize, hashdiff=excluded.hashdiff, "
+                                  "duplicate_behavior=excluded.duplicate_behavior",
                                   (channel.guild.id, channel.id, hashsize, hashdiff, duplicate_behavior))
-        await database.db.commit()
+        await database.commit()
+        # hashsize might have changed
+        imagehashindex.drop(channel.id)
 
         if exists:
             await ctx.reply("✔ Updated Image Set.")
         else:
             msg = await ctx.reply("⚙ Hashing channel...")
-            await hashchannel(channel)
+            status = ScanStatus(channel)
+            reporter = asyncio.create_task(report_scan(msg, "⚙ Hashing channel...", [status]))
+            try:
+                await hashchannel(channel, status)
+            finally:
+                reporter.cancel()
             await msg.delete()
             await ctx.reply("✔ Created Image Set.")
 
@@ -208,7 +570,8 @@ class ImageSetCog(commands.Cog):
         assert channel.guild == ctx.guild, "channel must be in current guild."
         cur = await database.db.execute("DELETE FROM imageset_channels WHERE channel=?", (channel.id,))
         await database.db.execute("DELETE FROM imageset_hashes WHERE channel=?", (channel.id,))
-        await database.db.commit()
+        await database.commit()
+        imagehashindex.drop(channel.id)
         if cur.rowcount > 0:
             await ctx.reply("✔️ Channel is no longer an Image Set.")
         else:
@@ -216,17 +579,38 @@ class ImageSetCog(commands.Cog):
 
     @moderation.mod_only()
     @commands.command()
-    async def rescanimagesets(self, ctx: commands.Context):
+    async def rescanimagesets(self, ctx: commands.Context, full: bool = False):
+        """
+        hash any images in this server's Image Sets that were sent since the last scan
+        :param ctx: discord context
+        :param full: also read back through all of history to forget images whose messages were deleted
+        """
         async with ctx.typing():
             channels = []
-            async with database.db.execute("SELECT channel FROM imageset_channels WHERE guild=?",
-                                           (ctx.guild.id,)) as cur:
-                async for (channel,) in cur:
-                    try:
-                        channels.append(await ctx.guild.fetch_channel(channel))
-                    except discord.NotFound:
-                        logger.debug(f"oopsie woopsie :3 (channel {channel} does not exist)")
-            await asyncio.gather(*[hashchannel(channel) for channel in channels])
+            async with database.read("SELECT channel FROM imageset_channels WHERE guild=?",
+                                     (ctx.guild.id,)) as cur:
+                rows = await cur.fetchall()
+            for (channel,) in rows:
+                try:
+                    channels.append(await ctx.guild.fetch_channel(channel))
+                except discord.NotFound:
+                    logger.debug(f"oopsie woopsie :3 (channel {channel} does not exist)")
+        msg = await ctx.reply("⚙ Rescanning Image Sets...")
+        statuses = [ScanStatus(channel) for channel in channels]
+        reporter = asyncio.create_task(report_scan(msg, "⚙ Rescanning Image Sets...", statuses))
+        slots = asyncio.Semaphore(rescan_concurrency)
+
+        async def rescan(status: ScanStatus):
+            async with slots:
+                if full:
+                    await prunechannel(status.channel, status)
+                await hashchannel(status.channel, status)
+
+        try:
+            await asyncio.gather(*[rescan(status) for status in statuses])
+        finally:
+            reporter.cancel()
+        await msg.delete()
         await ctx.reply("Done!")
 
 
@@ -35,7 +35,7 @@ class MacroCog(commands.Cog, name="Macros"):
         await database.db.execute(
             "INSERT INTO macros(server,name,content) VALUES (?,?,?)",
             (ctx.guild.id, name, content))
-        await database.db.commit()
+        await database.commit()
         await ctx.reply(f"✔️ Added macro `{name}`.")
         await modlog(f"{ctx.author.mention} (`{ctx.author}`) added macro `{name}` with content:\n{quote(content)}",
                      ctx.guild.id, modid=ctx.author.id)
@@ -52,7 +52,7 @@ class MacroCog(commands.Cog, name="Macros"):
         cur = await database.db.execute(
             "DELETE FROM macros WHERE server=? AND name=?",
             (ctx.guild.id, name))
-        await database.db.commit()
+        await database.commit()
         if cur.rowcount > 0:
             await ctx.reply(f"✔️ Deleted macro {name}.")
             await modlog(f"{ctx.author.mention} (`{ctx.author}`) deleted macro `{name}`.", ctx.guild.id,
@@ -70,13 +70,13 @@ class MacroCog(commands.Cog, name="Macros"):
         """
         if name is None:
             return await self.macros(ctx)
-        async with database.db.execute("SELECT content FROM macros WHERE server=? AND name=?",
-                                       (ctx.guild.id, name)) as cur:
+        async with database.read("SELECT content FROM macros WHERE server=? AND name=?",
+                                 (ctx.guild.id, name)) as cur:
             result = await cur.fetchone()
         returned_result = result is not None and result[0] is not None
         if not returned_result:
-            async with database.db.execute("SELECT name FROM macros WHERE server=?",
-                                           (ctx.guild.id,)) as cursor:
+            async with database.read("SELECT name FROM macros WHERE server=?",
+                                     (ctx.guild.id,)) as cursor:
                 macros = [res[0] for res in await cursor.fetchall()]
             match = difflib.get_close_matches(name, macros, n=1, cutoff=0)[0]
             await ctx.reply(f"⚠️ No macro found with that name. Did you mean `{ctx.prefix}{ctx.invoked_with} {match}`?")
@@ -88,8 +88,8 @@ class MacroCog(commands.Cog, name="Macros"):
         """
         list all available macros
         """
-        async with database.db.execute("SELECT name FROM macros WHERE server=?",
-                                       (ctx.guild.id,)) as cursor:
+        async with database.read("SELECT name FROM macros WHERE server=?",
+                                 (ctx.guild.id,)) as cursor:
             macros = [f"`{i[0]}`" for i in await cursor.fetchall()]
         outstr = f"{len(macros)} macro{'' if len(macros) == 1 else 's'}: {', '.join(macros)}"
         if len(outstr) < 2000:
@@ -9,6 +9,7 @@ from discord.ext import commands
 import config
 import database
 import errhandler
+import migrations
 import scheduler
 from admincommands import AdminCommands
 from autoreaction import AutoReactionCog
@@ -31,25 +32,6 @@ from utilitycommands import UtilityCommands
 from wordsinthebible import BibleCog
 from xp import ExperienceCog
 
-if not os.path.exists(config.temp_dir.rstrip("/")):
-    os.mkdir(config.temp_dir.rstrip("/"))
-for f in glob.glob(f'{config.temp_dir}*'):
-    os.remove(f)
-# init db if not ready
-logger.debug("checking db")
-con = sqlite3.connect("database.sqlite")
-cur = con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_master' AND name != "
-                  "'sqlite_sequence'")
-numoftables = cur.fetchone()[0]
-if numoftables == 0:
-    logger.debug("detected empty database, initializing")
-    with open("makedatabase.sql", "r") as f:
-        makesql = f.read()
-    with con:
-        con.executescript(makesql)
-    logger.debug("initialized db!")
-con.close()
-
 # loop = asyncio.new_event_loop()
 # loop.run_until_complete(create_db())
 # loop.close()
@@ -121,6 +103,11 @@ class MyBot(commands.Bot):
         await bot.add_cog(TypeShit(bot))
         await scheduler.start()
 
+    async def close(self):
+        await super().close()
+        # commit anything still waiting on a group commit
+        await database.close()
+
 
 bot = MyBot(command_prefix=commands.when_mentioned_or(*allcasecombinations(config.command_prefix)), help_command=None,
             case_insensitive=True,
@@ -171,4 +158,25 @@ async def leave(ctx: commands.Context, guild: discord.Guild):
     await ctx.reply(f"Left {guild} ({guild.id})")
 
 
-bot.run(config.bot_token)
+# the image hash workers import this file as __mp_main__, they mustn't clear temp files or start a bot of their own
+if __name__ == "__main__":
+    if not os.path.exists(config.temp_dir.rstrip("/")):
+        os.mkdir(config.temp_dir.rstrip("/"))
+    for f in glob.glob(f'{config.temp_dir}*'):
+        os.remove(f)
+    # init db if not ready
+    logger.debug("checking db")
+    con = sqlite3.connect("database.sqlite")
+    cur = con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_master' AND name != "
+                      "'sqlite_sequence'")
+    numoftables = cur.fetchone()[0]
+    if numoftables == 0:
+        logger.debug("detected empty database, initializing")
+        with open("makedatabase.sql", "r") as f:
+            makesql = f.read()
+        with con:
+            con.executescript(makesql)
+        logger.debug("initialized db!")
+    migrations.migrate(con)
+    con.close()
+    bot.run(config.bot_token)
@@ -0,0 +1,133 @@
+import sqlite3
+import typing
+
+from clogs import logger
+
+
+def _imageset_hashes_to_blobs(con: sqlite3.Connection):
+    # hex text -> the same bits as a blob. sqlite can't change a column's type so the table gets rebuilt
+    con.create_function("hex_to_blob", 1, lambda h: int(h, 16).to_bytes((len(h) * 4 + 7) // 8, "big"),
+                        deterministic=True)
+    con.execute("""
+    CREATE TABLE imageset_hashes_new
+    (
+        guild        integer not null,
+        channel      integer not null,
+        message      integer not null,
+        att_url      text    not null
+            constraint key_name
+                primary key
+                    on conflict ignore,
+        hash         blob    not null, -- phash bits, big endian, see imagehashindex.hash_bytes()
+        message_url  text    not null,
+        image_width  integer not null,
+        image_height integer not null
+    )
+    """)
+    con.execute("INSERT INTO imageset_hashes_new SELECT guild, channel, message, att_url, hex_to_blob(hash), "
+                "message_url, image_width, image_height FROM imageset_hashes")
+    con.execute("DROP TABLE imageset_hashes")
+    con.execute("ALTER TABLE imageset_hashes_new RENAME TO imageset_hashes")
+    con.execute("CREATE INDEX imageset_hashes_channel ON imageset_hashes (channel)")
+    con.execute("CREATE INDEX imageset_hashes_message ON imageset_hashes (message)")
+
+
+# makedatabase.sql is schema version 0. every entry here bumps the version by 1 and is applied in order, once.
+# entries are either a sql script or a function that takes the raw sqlite3 connection for things sql can't do alone.
+# NEVER edit or reorder an entry once it's been committed, only append new ones.
+migrations: list[typing.Union[str, typing.Callable[[sqlite3.Connection], None]]] = [
+    # 1: indexes for the hot lookups, all of these were full table scans
+    """
+    CREATE INDEX IF NOT EXISTS warnings_server_user ON warnings (server, user, deactivated, issuedat, points);
+    CREATE INDEX IF NOT EXISTS modlog_guild_user ON modlog (guild, user, datetime);
+    CREATE INDEX IF NOT EXISTS modlog_guild_moderator ON modlog (guild, moderator, datetime);
+    CREATE INDEX IF NOT EXISTS auto_reactions_channel ON auto_reactions (channel, emoji);
+    CREATE INDEX IF NOT EXISTS imageset_hashes_channel ON imageset_hashes (channel);
+    CREATE INDEX IF NOT EXISTS imageset_hashes_message ON imageset_hashes (message);
+    CREATE INDEX IF NOT EXISTS members_to_verify_guild_member ON members_to_verify (guild, member);
+    CREATE INDEX IF NOT EXISTS members_to_verify_guild_thread ON members_to_verify (guild, thread);
+    """,
+    # 2: pull the ids that events get looked up by out of the eventdata json and into real indexed columns
+    """
+    ALTER TABLE schedule ADD COLUMN guild int;
+    ALTER TABLE schedule ADD COLUMN member int;
+    ALTER TABLE schedule ADD COLUMN user int;
+    UPDATE schedule SET guild  = json_extract(eventdata, '$.guild'),
+                        member = json_extract(eventdata, '$.member'),
+                        user   = json_extract(eventdata, '$.user');
+    CREATE INDEX schedule_guild_member ON schedule (guild, member, eventtype);
+    CREATE INDEX schedule_user ON schedule (user, eventtype);
+    """,
+    # 3: the scheduler pages events in by time instead of loading the whole table
+    """
+    CREATE INDEX schedule_eventtime ON schedule (eventtime);
+    """,
+    # 4: XP recalculation jobs, checkpointed so they survive a restart
+    """
+    CREATE TABLE xp_recalc_jobs
+    (
+        guild           int PRIMARY KEY,
+        channel         int   NOT NULL, -- where to report progress and the result
+        message         int,            -- the progress message
+        time_between_xp float NOT NULL, -- fixed at the start so a resumed job counts the same way
+        scanning        bool  NOT NULL DEFAULT false, -- true once xp_recalc_channels has every channel
+        messages        int   NOT NULL DEFAULT 0 -- messages counted as of the last checkpoint
+    );
+    CREATE TABLE xp_recalc_channels
+    (
+        guild        int NOT NULL,
+        channel      int NOT NULL,
+        last_message int, -- last message counted as of the last checkpoint, NULL if none yet
+        PRIMARY KEY (guild, channel)
+    );
+    CREATE TABLE xp_recalc_users
+    (
+        guild        int   NOT NULL,
+        user         int   NOT NULL,
+        experience   int   NOT NULL,
+        last_xp_gain float NOT NULL, -- timestamp of the message that last gave XP
+        PRIMARY KEY (guild, user)
+    );
+    """,
+    # 5: leaderboard pages seek through this instead of sorting the guild
+    """
+    CREATE INDEX experience_guild_experience ON experience (guild, experience DESC, user);
+    """,
+    # 6: recalculations write a snapshot of the messages they counted, this is how far it got as of the checkpoint
+    """
+    ALTER TABLE xp_recalc_jobs ADD COLUMN snapshot_rows int NOT NULL DEFAULT 0;
+    """,
+    # 7: image hashes as blobs instead of hex text
+    _imageset_hashes_to_blobs,
+    # 8: rescans pick up from the last message a scan fully processed instead of reading the whole channel again
+    """
+    ALTER TABLE imageset_channels ADD COLUMN last_message int;
+    """,
+]
+
+
+def migrate(con: sqlite3.Connection):
+    """bring the database up to the latest schema version"""
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(migrations):
+        raise RuntimeError(f"database is schema version {version} but this code only knows up to "
+                           f"{len(migrations)}. did you downgrade?")
+    for i, migration in enumerate(migrations[version:], start=version + 1):
+        logger.debug(f"migrating database to schema version {i}")
+        # each migration and its version bump commit together so a crash halfway through can't skip one
+        con.execute("BEGIN")
+        try:
+            if callable(migration):
+                migration(con)
+            else:
+                # executescript() commits on its own, so run the statements one by one to keep them in the transaction
+                for statement in migration.split(";"):
+                    if statement.strip():
+                        con.execute(statement)
+            con.execute(f"PRAGMA user_version = {i}")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    if version < len(migrations):
+        logger.debug(f"database is now schema version {len(migrations)}")
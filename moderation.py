@@ -14,6 +14,7 @@ import config
 import database
 import modlog
 import scheduler
+import serverconfig
 from clogs import logger
 from embedutils import add_long_field, split_embed
 from timeconverter import time_converter
@@ -56,23 +57,12 @@ def mod_only():
 
 async def update_server_config(server: int, config: str, value):
     """DO NOT ALLOW CONFIG TO BE PASSED AS A VARIABLE, PRE-DEFINED STRINGS ONLY."""
-    async with database.db.execute("SELECT COUNT(guild) FROM server_config WHERE guild=?", (server,)) as cur:
-        guilds = await cur.fetchone()
-    if guilds[0]:  # if there already is a row for this guild
-        await database.db.execute(f"UPDATE server_config SET {config} = ? WHERE guild=?", (value, server))
-    else:  # if not, make one
-        await database.db.execute(f"INSERT INTO server_config(guild, {config}) VALUES (?, ?)", (server, value))
-    await database.db.commit()
+    await serverconfig.update(server, config, value)
 
 
 async def get_server_config(guild: int, config: str):
     """DO NOT ALLOW CONFIG TO BE PASSED AS A VARIABLE, PRE-DEFINED STRINGS ONLY."""
-    async with database.db.execute(f"SELECT {config} FROM server_config WHERE guild=?", (guild,)) as cur:
-        conf = await cur.fetchone()
-    if conf is None:
-        return None
-    else:
-        return conf[0]
+    return getattr(await serverconfig.get(guild), config)
 
 
 async def ban_action(user: typing.Union[discord.User, discord.Member], guild: discord.Guild,
@@ -147,16 +137,13 @@ async def mute_action(member: discord.Member, mute_length: typing.Optional[timed
 
 
 async def on_warn(member: discord.Member, issued_points: float):
-    async with database.db.execute("SELECT thin_ice_role, thin_ice_threshold FROM server_config WHERE guild=?",
-                                   (member.guild.id,)) as cur:
-        thin_ice_role = await cur.fetchone()
-    if thin_ice_role is not None and thin_ice_role[0] is not None and thin_ice_role[0] in [role.id for role in
-                                                                                           member.roles]:
+    conf = await serverconfig.get(member.guild.id)
+    if conf.thin_ice_role is not None and conf.thin_ice_role in [role.id for role in member.roles]:
         await database.db.execute(
             "UPDATE thin_ice SET warns_on_thin_ice = warns_on_thin_ice+? WHERE guild=? AND user=?",
             (issued_points, member.guild.id, member.id))
-        await database.db.commit()
-        threshold = thin_ice_role[1]
+        await database.commit()
+        threshold = conf.thin_ice_threshold
         async with database.db.execute("SELECT warns_on_thin_ice FROM thin_ice WHERE guild=? AND user=?",
                                        (member.guild.id, member.id)) as cur:
             warns_on_thin_ice = (await cur.fetchone())[0]
@@ -168,7 +155,7 @@ async def on_warn(member: discord.Member, issued_points: float):
                                 f"points on thin ice.", member.guild.id, member.id)
             await database.db.execute("UPDATE thin_ice SET warns_on_thin_ice = 0 WHERE guild=? AND user=?",
                                       (member.guild.id, member.id))
-            await database.db.commit()
+            await database.commit()
 
     else:
         # select all from punishments where the sum of warnings in the punishment range fits the warn_count thing
@@ -251,17 +238,14 @@ class ModerationCog(commands.Cog, name="Moderation"):
     @commands.Cog.listener()
     async def on_member_unban(self, guild: discord.Guild, user: discord.User):
         actuallycancelledanytasks = False
-        async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                       "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                       (guild.id, user.id, "unban")) as cur:
-            async for row in cur:
-                await scheduler.canceltask(row[0])
-                actuallycancelledanytasks = True
+        for taskid in await scheduler.find_member_tasks(["unban"], guild.id, user.id):
+            await scheduler.canceltask(taskid)
+            actuallycancelledanytasks = True
         thin_ice_role = await get_server_config(guild.id, "thin_ice_role")
         if thin_ice_role is not None:
             await database.db.execute("REPLACE INTO thin_ice(user,guild,marked_for_thin_ice,warns_on_thin_ice) VALUES "
                                       "(?,?,?,?)", (user.id, guild.id, True, 0))
-            await database.db.commit()
+            await database.commit()
         if actuallycancelledanytasks:
             try:
                 await user.send(f"You were manually unbanned in **{guild.name}**.")
@@ -276,11 +260,8 @@ class ModerationCog(commands.Cog, name="Moderation"):
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild: discord.Guild, user: discord.User):
-        async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                       "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                       (guild.id, user.id, "un_thin_ice")) as cur:
-            async for row in cur:
-                await scheduler.canceltask(row[0])
+        for taskid in await scheduler.find_member_tasks(["un_thin_ice"], guild.id, user.id):
+            await scheduler.canceltask(taskid)
         ban_appeal_link = await get_server_config(guild.id, "ban_appeal_link")
         if ban_appeal_link is not None:
             try:
@@ -291,54 +272,46 @@ class ModerationCog(commands.Cog, name="Moderation"):
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
         # delete unmute events if someone manually untimed out
-        if is_timedout(before) is not None and is_timedout(after) is None:  # if muted role manually removed
+        if is_timedout(before) and not is_timedout(after):  # if timeout manually removed
             actuallycancelledanytasks = False
-            async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                           "AND json_extract(eventdata, \"$.member\")=? AND (eventtype=? OR "
-                                           "eventtype=?)",
-                                           (after.guild.id, after.id, "unmute", "refresh_mute")) as cur:
-                async for row in cur:
-                    await scheduler.canceltask(row[0])
-                    actuallycancelledanytasks = True
+            for taskid in await scheduler.find_member_tasks(["unmute", "refresh_mute"],
+                                                            after.guild.id, after.id):
+                await scheduler.canceltask(taskid)
+                actuallycancelledanytasks = True
             if actuallycancelledanytasks:
                 await after.send(f"You were manually unmuted in **{after.guild.name}**.")
         # remove thin ice from records if manually removed
-        thin_ice_role = await get_server_config(after.guild.id, "mod_role")
+        thin_ice_role = await get_server_config(after.guild.id, "thin_ice_role")
         if thin_ice_role is not None:
             if thin_ice_role in [role.id for role in before.roles] \
                     and thin_ice_role not in [role.id for role in after.roles]:  # if muted role manually removed
                 actuallycancelledanytasks = False
-                async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                               "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                               (after.guild.id, after.id, "un_thin_ice")) as cur:
-                    async for row in cur:
-                        await scheduler.canceltask(row[0])
-                        await database.db.execute("DELETE FROM thin_ice WHERE guild=? and user=?",
-                                                  (after.guild.id, after.id))
-                        actuallycancelledanytasks = True
-                    await database.db.commit()
+                for taskid in await scheduler.find_member_tasks(["un_thin_ice"], after.guild.id, after.id):
+                    await scheduler.canceltask(taskid)
+                    actuallycancelledanytasks = True
                 if actuallycancelledanytasks:
+                    await database.db.execute("DELETE FROM thin_ice WHERE guild=? and user=?",
+                                              (after.guild.id, after.id))
+                    await database.commit()
                     await after.send(f"Your thin ice was manually removed in **{after.guild.name}**.")
                     await modlog.modlog(f"{after.mention} (`{after}`)'s thin ice was manually removed.",
                                         guildid=after.guild.id, userid=after.id)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
-        async with database.db.execute("SELECT thin_ice_role, thin_ice_threshold FROM server_config WHERE guild=?",
-                                       (member.guild.id,)) as cur:
-            thin_ice_role = await cur.fetchone()
-        if thin_ice_role is not None and thin_ice_role[0] is not None:
+        conf = await serverconfig.get(member.guild.id)
+        if conf.thin_ice_role is not None:
             async with database.db.execute("SELECT * from thin_ice WHERE user=? AND guild=? AND marked_for_thin_ice=1",
                                            (member.id, member.guild.id)) as cur:
                 user = await cur.fetchone()
             if user is not None:
-                await member.add_roles(discord.Object(thin_ice_role[0]))
+                await member.add_roles(discord.Object(conf.thin_ice_role))
                 scheduletime = datetime.now(tz=timezone.utc) + timedelta(weeks=1)
                 await scheduler.schedule(scheduletime, "un_thin_ice",
                                          {"guild": member.guild.id, "member": member.id,
-                                          "thin_ice_role": thin_ice_role[0]})
+                                          "thin_ice_role": conf.thin_ice_role})
                 await member.send(f"Welcome back to **{member.guild.name}**. since you were just unbanned, you will"
-                                  f" have the **thin ice** role for **1 week.** If you receive {thin_ice_role[1]} "
+                                  f" have the **thin ice** role for **1 week.** If you receive {conf.thin_ice_threshold} "
                                   f"point(s) in this timespan, you will be permanently banned.")
 
     @commands.command(aliases=["setmodrole", "addmodrole", "moderatorrole"])
@@ -600,11 +573,9 @@ class ModerationCog(commands.Cog, name="Moderation"):
             return
         for member in members:
             # cancel all unmute events
-            async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                           "AND json_extract(eventdata, \"$.member\")=? AND (eventtype=? OR eventtype=?)",
-                                           (ctx.guild.id, member.id, "unmute", "refresh_mute")) as cur:
-                async for row in cur:
-                    await scheduler.canceltask(row[0])
+            for taskid in await scheduler.find_member_tasks(["unmute", "refresh_mute"],
+                                                            ctx.guild.id, member.id):
+                await scheduler.canceltask(taskid)
 
             await member.timeout(None)
             await ctx.reply(f"✔️ Unmuted {member.mention}")
@@ -642,11 +613,8 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 await member.send(f"You were manually unbanned in **{ctx.guild.name}**.")
             except (discord.Forbidden, discord.HTTPException, AttributeError):
                 logger.debug("pass")
-            async with database.db.execute("SELECT id FROM schedule WHERE json_extract(eventdata, \"$.guild\")=? "
-                                           "AND json_extract(eventdata, \"$.member\")=? AND eventtype=?",
-                                           (ctx.guild.id, member.id, "unban")) as cur:
-                async for row in cur:
-                    await scheduler.canceltask(row[0])
+            for taskid in await scheduler.find_member_tasks(["unban"], ctx.guild.id, member.id):
+                await scheduler.canceltask(taskid)
 
     @commands.command(aliases=["deletewarn", "removewarn", "dwarn", "cancelwarn", "dw"])
     @mod_only()
@@ -672,16 +640,12 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 # update warns on thin ice
                 member = await ctx.guild.fetch_member(warn[0])
                 points = warn[1]
-                async with database.db.execute(
-                        "SELECT thin_ice_role, thin_ice_threshold FROM server_config WHERE guild=?",
-                        (member.guild.id,)) as cur:
-                    thin_ice_role = await cur.fetchone()
-                if thin_ice_role is not None and thin_ice_role[0] is not None \
-                        and thin_ice_role[0] in [role.id for role in member.roles]:
+                thin_ice_role = await get_server_config(member.guild.id, "thin_ice_role")
+                if thin_ice_role is not None and thin_ice_role in [role.id for role in member.roles]:
                     await database.db.execute(
                         "UPDATE thin_ice SET warns_on_thin_ice = warns_on_thin_ice-? WHERE guild=? AND user=?",
                         (points, member.guild.id, member.id))
-                await database.db.commit()
+                await database.commit()
                 user = await self.bot.fetch_user(warn[0])
                 if user:
                     await ctx.reply(f"✔️ Removed warning #{warn_id} from {user.mention} (`{warn[2]}`)")
@@ -718,7 +682,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 f"❌ Failed to unremove warning. Does warn #{warn_id} exist and is it from this server?")
         else:
             await database.db.execute("UPDATE warnings SET deactivated=1 WHERE id=?", (warn_id,))
-            await database.db.commit()
+            await database.commit()
             user = await self.bot.fetch_user(warn[0])
             if user:
                 await ctx.reply(f"✔️ Restored warning #{warn_id} from {user.mention} (`{warn[2]}`)")
@@ -760,7 +724,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                                   (ctx.guild.id, member.id, ctx.author.id,
                                    int(now.timestamp()), reason, points))
                 insertedrow = cur.lastrowid
-            await database.db.commit()
+            await database.commit()
 
             await ctx.reply(
                 f"Warned {member.mention} (warn ID `#{insertedrow}`) with {points} infraction point{'' if points == 1 else 's'} for:\n"
@@ -817,7 +781,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                                   "VALUES (?, ?, ?, ?, ?, ?)",
                                   (ctx.guild.id, member.id, ctx.author.id,
                                    int(now.timestamp()), reason, points))
-        await database.db.commit()
+        await database.commit()
         await ctx.reply(
             f"Created warn on <t:{int(now.timestamp())}:D> for {member.mention} with {points} infraction "
             f"point{'' if points == 1 else 's'} for:\n{quote(reason)}")
@@ -850,31 +814,32 @@ class ModerationCog(commands.Cog, name="Moderation"):
             embed = discord.Embed(title=f"Warns for {member.display_name}: Page {page}", color=discord.Color(0xB565D9),
                                   description=member.mention)
             deactivated_text = "" if show_deleted else "AND deactivated=0"
-            async with database.db.execute(f"SELECT id, issuedby, issuedat, reason, deactivated, points FROM warnings "
-                                           f"WHERE user=? AND server=? {deactivated_text} ORDER BY issuedat DESC "
-                                           f"LIMIT 25 OFFSET ?",
-                                           (member.id, ctx.guild.id, (page - 1) * 25)) as cursor:
-                # now = datetime.now(tz=timezone.utc)
-                async for warn in cursor:
-                    issuedby = await self.bot.fetch_user(warn[1])
-                    issuedat = warn[2]
-                    reason = warn[3]
-                    points = warn[5]
-                    add_long_field(embed,
-                                   name=f"Warn ID `#{warn[0]}`: {'%g' % points} point{'' if points == 1 else 's'}"
-                                        f"{' (Deleted)' if warn[4] else ''}",
-                                   value=
-                                   f"Reason: {reason}\n"
-                                   f"Issued by: {issuedby.mention}\n"
-                                   f"Issued <t:{int(issuedat)}:f> "
-                                   f"(<t:{int(issuedat)}:R>)", inline=False)
-            async with database.db.execute("SELECT count(*) FROM warnings WHERE user=? AND server=? AND deactivated=0",
-                                           (member.id, ctx.guild.id)) as cur:
+            async with database.read(f"SELECT id, issuedby, issuedat, reason, deactivated, points FROM warnings "
+                                     f"WHERE user=? AND server=? {deactivated_text} ORDER BY issuedat DESC "
+                                     f"LIMIT 25 OFFSET ?",
+                                     (member.id, ctx.guild.id, (page - 1) * 25)) as cursor:
+                warns = await cursor.fetchall()
+            # now = datetime.now(tz=timezone.utc)
+            for warn in warns:
+                issuedby = await self.bot.fetch_user(warn[1])
+                issuedat = warn[2]
+                reason = warn[3]
+                points = warn[5]
+                add_long_field(embed,
+                               name=f"Warn ID `#{warn[0]}`: {'%g' % points} point{'' if points == 1 else 's'}"
+                                    f"{' (Deleted)' if warn[4] else ''}",
+                               value=
+                               f"Reason: {reason}\n"
+                               f"Issued by: {issuedby.mention}\n"
+                               f"Issued <t:{int(issuedat)}:f> "
+                               f"(<t:{int(issuedat)}:R>)", inline=False)
+            async with database.read("SELECT count(*) FROM warnings WHERE user=? AND server=? AND deactivated=0",
+                                     (member.id, ctx.guild.id)) as cur:
                 warncount = (await cur.fetchone())[0]
-            async with database.db.execute("SELECT count(*) FROM warnings WHERE user=? AND server=? AND deactivated=1",
-                                           (member.id, ctx.guild.id)) as cur:
+            async with database.read("SELECT count(*) FROM warnings WHERE user=? AND server=? AND deactivated=1",
+                                     (member.id, ctx.guild.id)) as cur:
                 delwarncount = (await cur.fetchone())[0]
-            async with database.db.execute(
+            async with database.read(
                     "SELECT sum(points) FROM warnings WHERE user=? AND server=? AND deactivated=0",
                     (member.id, ctx.guild.id)) as cur:
                 points = (await cur.fetchone())[0]
@@ -906,32 +871,33 @@ class ModerationCog(commands.Cog, name="Moderation"):
         async with ctx.channel.typing():
             embed = discord.Embed(title=f"Modlogs for {member.display_name}: Page {page}",
                                   color=discord.Color(0xB565D9), description=member.mention)
-            async with database.db.execute(f"SELECT text,datetime,user,moderator FROM modlog "
-                                           f"WHERE {'moderator' if viewmodactions else 'user'}=? AND guild=? "
-                                           f"ORDER BY datetime DESC LIMIT 10 OFFSET ?",
-                                           (member.id, ctx.guild.id, (page - 1) * 10)) as cursor:
-                now = datetime.now(tz=timezone.utc)
-                async for log in cursor:
-                    if log[2]:
-                        user: typing.Optional[discord.User] = await self.bot.fetch_user(log[2])
-                    else:
-                        user = None
-                    if log[3]:
-                        moderator: typing.Optional[discord.User] = await self.bot.fetch_user(log[3])
-                    else:
-                        moderator = None
-                    issuedat = log[1]
-                    text = log[0]
-                    add_long_field(embed,
-                                   name=f"<t:{int(issuedat)}:f> (<t:{int(issuedat)}:R>)",
-                                   value=
-                                   text + ("\n\n" if user or moderator else "") +
-                                   (f"**User**: {user.mention}\n" if user else "") +
-                                   (f"**Moderator**: {moderator.mention}\n" if moderator else ""), inline=False)
-                if not embed.fields:
-                    embed.add_field(name="No Results", value="Try a different page #.", inline=False)
-                for e in split_embed(embed):
-                    await ctx.reply(embed=e)
+            async with database.read(f"SELECT text,datetime,user,moderator FROM modlog "
+                                     f"WHERE {'moderator' if viewmodactions else 'user'}=? AND guild=? "
+                                     f"ORDER BY datetime DESC LIMIT 10 OFFSET ?",
+                                     (member.id, ctx.guild.id, (page - 1) * 10)) as cursor:
+                logs = await cursor.fetchall()
+            now = datetime.now(tz=timezone.utc)
+            for log in logs:
+                if log[2]:
+                    user: typing.Optional[discord.User] = await self.bot.fetch_user(log[2])
+                else:
+                    user = None
+                if log[3]:
+                    moderator: typing.Optional[discord.User] = await self.bot.fetch_user(log[3])
+                else:
+                    moderator = None
+                issuedat = log[1]
+                text = log[0]
+                add_long_field(embed,
+                               name=f"<t:{int(issuedat)}:f> (<t:{int(issuedat)}:R>)",
+                               value=
+                               text + ("\n\n" if user or moderator else "") +
+                               (f"**User**: {user.mention}\n" if user else "") +
+                               (f"**Moderator**: {moderator.mention}\n" if moderator else ""), inline=False)
+            if not embed.fields:
+                embed.add_field(name="No Results", value="Try a different page #.", inline=False)
+            for e in split_embed(embed):
+                await ctx.reply(embed=e)
 
     def autopunishment_to_text(self, point_count, point_timespan, punishment_type, punishment_duration):
         punishment_type_future_tense = {
@@ -973,7 +939,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
             "VALUES (?,?,?,?,?)",
             (ctx.guild.id, point_count, punishment_type, punishment_duration.total_seconds(),
              point_timespan.total_seconds()))
-        await database.db.commit()
+        await database.commit()
 
     @commands.command(aliases=["removeap", "delap", "deleteautopunishment", "rap", "dap"])
     @commands.guild_only()
@@ -988,7 +954,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
         assert point_count > 0
         cur = await database.db.execute("DELETE FROM auto_punishment WHERE warn_count=? AND guild=?",
                                         (point_count, ctx.guild.id))
-        await database.db.commit()
+        await database.commit()
         if cur.rowcount > 0:
             await ctx.reply(f"✔️ Removed rule for {point_count} point{'' if point_count == 1 else 's'}.")
             await modlog.modlog(f"{ctx.author.mention} (`{ctx.author}`) removed "
@@ -1003,8 +969,8 @@ class ModerationCog(commands.Cog, name="Moderation"):
         Lists the auto-punishments for the server.
         """
         embed = discord.Embed(title=f"Auto-punishment rules for {ctx.guild.name}", color=discord.Color(0xB565D9))
-        async with database.db.execute("SELECT * FROM auto_punishment WHERE guild=? ORDER BY warn_count DESC LIMIT 25",
-                                       (ctx.guild.id,)) as cursor:
+        async with database.read("SELECT * FROM auto_punishment WHERE guild=? ORDER BY warn_count DESC LIMIT 25",
+                                 (ctx.guild.id,)) as cursor:
             async for p in cursor:
                 value = self.autopunishment_to_text(p[1], timedelta(seconds=p[4]), p[2], timedelta(seconds=p[3]))
                 embed.add_field(name=f"Rule for {p[1]} point{'' if p[1] == 1 else 's'}", value=value, inline=False)
@@ -1066,7 +1032,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 logger.debug(perms)
                 await database.db.execute("INSERT INTO lockedchannelperms VALUES (?,?,?)",
                                           (channel.guild.id, channel.id, perms))
-                await database.db.commit()
+                await database.commit()
                 # update perms
                 modrole = ctx.guild.get_role(int(await get_server_config(ctx.guild.id, "mod_role")))
                 for target, ovr in channel.overwrites.items():
@@ -1109,7 +1075,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
                 # update db
                 await database.db.execute("DELETE FROM lockedchannelperms WHERE guild=? AND channel=?",
                                           (channel.guild.id, channel.id))
-                await database.db.commit()
+                await database.commit()
                 # reply!
                 await modlog.modlog(f"{ctx.author.mention} (`@{ctx.author}`) unlocked {channel.mention} (`#{channel}`)",
                                     ctx.guild.id, modid=ctx.author.id)
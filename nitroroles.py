@@ -8,6 +8,7 @@ from discord.http import Route
 
 import database
 import moderation
+import serverconfig
 
 
 class UnicodeEmojiNotFound(commands.BadArgument):
@@ -39,9 +40,7 @@ def booster_only():
 
 
 async def on_booster_remove(member: discord.Member):
-    cur: aiosqlite.Cursor = await database.db.execute("SELECT booster_roles FROM main.server_config WHERE guild=?",
-                                                      (member.guild.id,))
-    booster_roles = await cur.fetchone()
+    booster_roles = (await serverconfig.get(member.guild.id)).booster_roles
     if booster_roles:
         cur: aiosqlite.Cursor = await database.db.execute("SELECT * FROM booster_roles WHERE guild=? AND user=?",
                                                           (member.guild.id, member.id))
@@ -56,9 +55,7 @@ async def on_booster_remove(member: discord.Member):
 
 
 async def on_booster_add(member: discord.Member):
-    cur: aiosqlite.Cursor = await database.db.execute("SELECT booster_roles FROM main.server_config WHERE guild=?",
-                                                      (member.guild.id,))
-    booster_roles = await cur.fetchone()
+    booster_roles = (await serverconfig.get(member.guild.id)).booster_roles
     if booster_roles:
         cur: aiosqlite.Cursor = await database.db.execute("SELECT * FROM booster_roles WHERE guild=? AND user=?",
                                                           (member.guild.id, member.id))
@@ -100,9 +97,7 @@ class NitroRolesCog(commands.Cog, name="Booster Roles"):
         :param ctx: discord context
         :param name: the name of your booster role, leave blank to remove.
         """
-        cur: aiosqlite.Cursor = await database.db.execute("SELECT booster_roles FROM main.server_config WHERE guild=?",
-                                                          (ctx.guild.id,))
-        booster_roles = await cur.fetchone()
+        booster_roles = (await serverconfig.get(ctx.guild.id)).booster_roles
         if booster_roles:
             cur: aiosqlite.Cursor = await database.db.execute("SELECT * FROM booster_roles WHERE guild=? AND user=?",
                                                               (ctx.guild.id, ctx.author.id))
@@ -118,26 +113,23 @@ class NitroRolesCog(commands.Cog, name="Booster Roles"):
                         await role.delete()
                         await database.db.execute("DELETE FROM booster_roles WHERE guild=? AND user=?",
                                                   (ctx.guild.id, ctx.author.id))
-                        await database.db.commit()
+                        await database.commit()
                         await ctx.reply("✔️ Deleted your booster role")
                     return
                 if name is None:
                     await ctx.reply("❓ Specify a name for your role")
                     return
             role = await ctx.guild.create_role(name=name, hoist=True)
-            cur: aiosqlite.Cursor = await database.db.execute(
-                "SELECT booster_role_hoist FROM main.server_config WHERE guild=?",
-                (ctx.guild.id,))
-            booster_role_hoist = await cur.fetchone()
-            if booster_role_hoist is not None and booster_role_hoist[0] is not None:
-                booster_role_hoist = ctx.guild.get_role(booster_role_hoist[0])
+            booster_role_hoist = (await serverconfig.get(ctx.guild.id)).booster_role_hoist
+            if booster_role_hoist is not None:
+                booster_role_hoist = ctx.guild.get_role(booster_role_hoist)
                 if booster_role_hoist is not None:
                     await ctx.guild.edit_role_positions({role: booster_role_hoist.position - 1})
             await ctx.author.add_roles(role)
             await database.db.execute(
                 "REPLACE INTO booster_roles (guild, user, role) VALUES (?, ?, ?)",
                 (ctx.guild.id, ctx.author.id, role.id))
-            await database.db.commit()
+            await database.commit()
             await ctx.reply(f"✔️ Created your booster role: {role.mention}")
         else:
             await ctx.reply("❌ Booster roles are not enabled on this server.")
@@ -150,9 +142,7 @@ class NitroRolesCog(commands.Cog, name="Booster Roles"):
         :param ctx: discord context
         :param color: hex or RGB color
         """
-        cur: aiosqlite.Cursor = await database.db.execute("SELECT booster_roles FROM main.server_config WHERE guild=?",
-                                                          (ctx.guild.id,))
-        booster_roles = await cur.fetchone()
+        booster_roles = (await serverconfig.get(ctx.guild.id)).booster_roles
         if booster_roles:
             cur: aiosqlite.Cursor = await database.db.execute("SELECT * FROM booster_roles WHERE guild=? AND user=?",
                                                               (ctx.guild.id, ctx.author.id))
@@ -209,9 +199,7 @@ class NitroRolesCog(commands.Cog, name="Booster Roles"):
         :param ctx: discord context
         :param icon: a unicode or discord emoji. leave blank to set icon to attachment or delete icon if no attachments
         """
-        cur: aiosqlite.Cursor = await database.db.execute("SELECT booster_roles FROM main.server_config WHERE guild=?",
-                                                          (ctx.guild.id,))
-        booster_roles = await cur.fetchone()
+        booster_roles = (await serverconfig.get(ctx.guild.id)).booster_roles
         if booster_roles:
             cur: aiosqlite.Cursor = await database.db.execute("SELECT * FROM booster_roles WHERE guild=? AND user=?",
                                                               (ctx.guild.id, ctx.author.id))
@@ -276,9 +264,7 @@ class NitroRolesCog(commands.Cog, name="Booster Roles"):
         :param member: the member to assign the role to
         :param role: the role to set as the booster role
         """
-        cur: aiosqlite.Cursor = await database.db.execute("SELECT booster_roles FROM main.server_config WHERE guild=?",
-                                                          (ctx.guild.id,))
-        booster_roles = await cur.fetchone()
+        booster_roles = (await serverconfig.get(ctx.guild.id)).booster_roles
         if booster_roles:
             cur: aiosqlite.Cursor = await database.db.execute("SELECT * FROM booster_roles WHERE guild=? AND user=?",
                                                               (ctx.guild.id, member.id))
@@ -290,7 +276,7 @@ class NitroRolesCog(commands.Cog, name="Booster Roles"):
             await member.add_roles(role)
             await database.db.execute("REPLACE INTO booster_roles (guild, user, role) VALUES (?,?,?)",
                                       (ctx.guild.id, member.id, role.id))
-            await database.db.commit()
+            await database.commit()
             await ctx.reply(f"✔️ Set {member.mention}'s booster role to {role.mention}.",
                             )
         else:
@@ -0,0 +1,45 @@
+import collections
+import typing
+
+
+class LatencyStats:
+    """running count and total of some duration, plus a rolling window of recent samples for percentiles"""
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.samples: collections.deque[float] = collections.deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """
+        nearest-rank percentile of the recent samples
+        :param p: percentile from 0 to 100
+        :return: duration in seconds, 0 if there are no samples
+        """
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}ms"
+
+
+def stats_table(stats: typing.Iterable[tuple[str, LatencyStats]]) -> str:
+    """format some named stats as a plain text table for a code block"""
+    lines = [f"{'count':>8} {'total':>10} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}  name"]
+    for name, stat in stats:
+        lines.append(f"{stat.count:>8} {format_ms(stat.total):>10} {format_ms(stat.mean):>9} "
+                     f"{format_ms(stat.percentile(50)):>9} {format_ms(stat.percentile(95)):>9} "
+                     f"{format_ms(stat.percentile(99)):>9}  {name}")
+    return "\n".join(lines)
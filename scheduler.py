@@ -1,6 +1,9 @@
 import asyncio
+import dataclasses
 import json
+import typing
 from datetime import datetime, timedelta, timezone
+from time import perf_counter
 
 import discord
 import humanize
@@ -9,11 +12,46 @@ from discord.ext import commands
 
 import database
 import modlog
+import serverconfig
 from clogs import logger
+from perfstats import LatencyStats, format_ms
 
 scheduler = TimedScheduler(timezone_aware=True)
 botcopy: commands.Bot
-loadedtasks = dict()  # keep track of task objects to cancel if needed.
+# only events due within this long are kept in memory, the rest wait in the db until they get close
+horizon = timedelta(hours=6)
+# how often to page the next stretch of events in. must be shorter than horizon or events would be late.
+refill_interval = timedelta(hours=1)
+# every event due up to this time is loaded, anything after it is only in the db
+loaded_until: typing.Optional[datetime] = None
+loadedtasks = dict()  # keep track of task objects to cancel if needed. None for missed events waiting on catch_up()
+# how many missed events of each type catch_up() runs at once. unbans and unmutes are a couple of REST calls each,
+# birthdays walk every guild and make channels so they get less
+catchup_concurrency = {"birthday": 1, "delbirthdaychannel": 2}
+catchup_default_concurrency = 4
+# events that start this many seconds after they were due get logged. missed events from downtime don't count.
+lag_warning_threshold = 5
+
+
+@dataclasses.dataclass
+class EventStats:
+    """how one event type has been doing since startup"""
+    # seconds between when the event was due and when it started running
+    lag: LatencyStats = dataclasses.field(default_factory=LatencyStats)
+    # seconds run_event spent on it
+    duration: LatencyStats = dataclasses.field(default_factory=LatencyStats)
+    succeeded: int = 0
+    failed: int = 0
+
+
+# eventtype -> stats
+eventstats: dict[str, EventStats] = {}
+# secondary indexes over loadedtasks so listeners can find events without asking the db.
+# (eventtype, guild, member) -> set of row ids, and (eventtype, user) -> set of row ids
+tasks_by_member: dict[tuple[str, int, int], set[int]] = {}
+tasks_by_user: dict[tuple[str, int], set[int]] = {}
+# row id -> the keys it's under in the indexes above, so it can be taken back out
+_taskkeys: dict[int, tuple[typing.Optional[tuple], typing.Optional[tuple]]] = {}
 
 
 class ScheduleInitCog(commands.Cog):
@@ -23,30 +61,184 @@ class ScheduleInitCog(commands.Cog):
         self.bot = bot
 
 
-async def start():
-    logger.debug("starting scheduler")
-    scheduler.start()
-    async with database.db.execute("SELECT id, eventtime, eventtype, eventdata FROM schedule") as cursor:
+def _track(dbrowid: int, task, eventtype: str, eventdata: dict):
+    loadedtasks[dbrowid] = task
+    memberkey = userkey = None
+    if eventdata.get("guild") is not None and eventdata.get("member") is not None:
+        memberkey = (eventtype, eventdata["guild"], eventdata["member"])
+        tasks_by_member.setdefault(memberkey, set()).add(dbrowid)
+    if eventdata.get("user") is not None:
+        userkey = (eventtype, eventdata["user"])
+        tasks_by_user.setdefault(userkey, set()).add(dbrowid)
+    _taskkeys[dbrowid] = (memberkey, userkey)
+
+
+def _untrack(dbrowid: int):
+    loadedtasks.pop(dbrowid, None)
+    memberkey, userkey = _taskkeys.pop(dbrowid, (None, None))
+    for index, key in ((tasks_by_member, memberkey), (tasks_by_user, userkey)):
+        if key is not None:
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(dbrowid)
+                if not ids:
+                    del index[key]
+
+
+async def find_member_tasks(eventtypes: typing.Iterable[str], guild: int, member: int) -> list[int]:
+    """
+    ids of pending events of any of these types for a member of a guild.
+    loaded events come from memory, the db is only asked about events past the horizon.
+    :param eventtypes: event types to look for, like ["unmute", "refresh_mute"]
+    :param guild: guild id
+    :param member: member id
+    :return: list of event ids, can be passed to canceltask()
+    """
+    eventtypes = list(eventtypes)
+    ids = {dbrowid for eventtype in eventtypes for dbrowid in tasks_by_member.get((eventtype, guild, member), ())}
+    async with database.db.execute(f"SELECT id FROM schedule WHERE guild=? AND member=? "
+                                   f"AND eventtype IN ({','.join('?' * len(eventtypes))}) AND eventtime > ?",
+                                   (guild, member, *eventtypes, loaded_until.timestamp())) as cur:
+        ids.update(row[0] for row in await cur.fetchall())
+    return list(ids)
+
+
+async def find_user_tasks(eventtype: str, user: int) -> list[int]:
+    """
+    ids of pending events of this type for a user.
+    loaded events come from memory, the db is only asked about events past the horizon.
+    :param eventtype: event type to look for, like "birthday"
+    :param user: user id
+    :return: list of event ids, can be passed to canceltask()
+    """
+    ids = set(tasks_by_user.get((eventtype, user), ()))
+    async with database.db.execute("SELECT id FROM schedule WHERE user=? AND eventtype=? AND eventtime > ?",
+                                   (user, eventtype, loaded_until.timestamp())) as cur:
+        ids.update(row[0] for row in await cur.fetchall())
+    return list(ids)
+
+
+async def load_until(until: datetime):
+    """
+    page every stored event due up to `until` into aioscheduler. events already loaded are skipped.
+    :param until: offset aware datetime to load up to
+    :return: list of (id, eventtype, eventdata) for events that were already overdue, these are NOT scheduled
+    """
+    global loaded_until
+    since = loaded_until.timestamp() if loaded_until is not None else float("-inf")
+    # move the line first so schedule() takes care of anything made while this query runs
+    loaded_until = until
+    now = datetime.now(tz=timezone.utc)
+    missed = []
+    loaded = 0
+    async with database.db.execute("SELECT id, eventtime, eventtype, eventdata FROM schedule "
+                                   "WHERE eventtime > ? AND eventtime <= ?", (since, until.timestamp())) as cursor:
         async for event in cursor:
+            if event[0] in loadedtasks:
+                continue
             data = json.loads(event[3])
             dt = datetime.fromtimestamp(event[1], tz=timezone.utc)
-            if dt <= datetime.now(tz=timezone.utc):
-                logger.debug(f"running missed event #{event[0]}")
-                # loadedtasks[event[0]] = task  # not needed but easier to put this here than to ignore the exception
-                await run_event(event[0], event[2], data)
+            if dt <= now:
+                missed.append((event[0], event[2], data))
             else:
-                logger.debug(f"scheduling stored event #{event[0]}")
-                task = scheduler.schedule(run_event(event[0], event[2], data), dt)
-                loadedtasks[event[0]] = task
+                task = scheduler.schedule(run_event(event[0], event[2], data, dt), dt)
+                _track(event[0], task, event[2], data)
+                loaded += 1
+    logger.debug(f"loaded {loaded} event(s) due before {until}")
+    return missed
+
+
+async def catch_up(missed: list[tuple[int, str, dict]]):
+    """
+    run overdue events in the background once the bot is ready, a few of each type at a time
+    :param missed: (id, eventtype, eventdata) for each overdue event, like load_until() returns
+    """
+    if not missed:
+        return
+    # indexed with no task so they can still be found and cancelled while they wait their turn
+    for dbrowid, eventtype, eventdata in missed:
+        _track(dbrowid, None, eventtype, eventdata)
+    await botcopy.wait_until_ready()
+    logger.info(f"catching up on {len(missed)} missed event(s)")
+    semaphores: dict[str, asyncio.Semaphore] = {}
+    done = 0
+
+    async def run(event: tuple[int, str, dict]):
+        nonlocal done
+        if event[1] not in semaphores:
+            semaphores[event[1]] = asyncio.Semaphore(catchup_concurrency.get(event[1], catchup_default_concurrency))
+        async with semaphores[event[1]]:
+            logger.debug(f"running missed event #{event[0]}")
+            await run_event(*event)
+        done += 1
+        if done % 25 == 0 or done == len(missed):
+            logger.info(f"caught up on {done}/{len(missed)} missed event(s)")
+
+    await asyncio.gather(*(run(event) for event in missed))
+
+
+async def _refill():
+    while True:
+        await asyncio.sleep(refill_interval.total_seconds())
+        try:
+            # only misses anything if the loop stalled for longer than horizon - refill_interval
+            missed = await load_until(datetime.now(tz=timezone.utc) + horizon)
+            asyncio.create_task(catch_up(missed))
+            if eventstats:
+                logger.info(f"scheduler stats since startup:\n{stats_table()}")
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+
+async def start():
+    logger.debug("starting scheduler")
+    scheduler.start()
+    missed = await load_until(datetime.now(tz=timezone.utc) + horizon)
+    asyncio.create_task(_refill())
+    # runs in the background so a pile of events from downtime doesn't hold up logging in
+    asyncio.create_task(catch_up(missed))
+
+
+def stats_table() -> str:
+    """format eventstats as a plain text table for a code block"""
+    lines = [f"{'ok':>6} {'failed':>6} {'lag p50':>9} {'lag p99':>9} {'lag max':>9} "
+             f"{'run p50':>9} {'run p99':>9} {'run max':>9}  eventtype"]
+    for eventtype, stats in sorted(eventstats.items()):
+        lines.append(f"{stats.succeeded:>6} {stats.failed:>6} "
+                     + " ".join(f"{format_ms(stat.percentile(p)):>9}"
+                                for stat in (stats.lag, stats.duration) for p in (50, 99, 100))
+                     + f"  {eventtype}")
+    return "\n".join(lines)
 
 
-async def run_event(dbrowid, eventtype: str, eventdata: dict):
+async def run_event(dbrowid, eventtype: str, eventdata: dict, eventtime: typing.Optional[datetime] = None):
+    """
+    run and delete a scheduled event
+    :param dbrowid: id in the schedule table, None if it was never stored
+    :param eventtype: what kind of event
+    :param eventdata: the event's arguments
+    :param eventtime: when it was due. leave as None for missed events so they don't count toward lag.
+    """
+    start = perf_counter()
+    lag = (datetime.now(tz=timezone.utc) - eventtime).total_seconds() if eventtime is not None else None
+    if eventtype not in eventstats:
+        eventstats[eventtype] = EventStats()
+    stats = eventstats[eventtype]
     try:
         logger.debug(f"Running Event #{dbrowid} type {eventtype} data {eventdata}")
         if dbrowid is not None:
-            await database.db.execute("DELETE FROM schedule WHERE id=?", (dbrowid,))
-            await database.db.commit()
-        del loadedtasks[dbrowid]
+            # it's running now, too late for anything to cancel it
+            _untrack(dbrowid)
+            async with database.db.execute("DELETE FROM schedule WHERE id=?", (dbrowid,)) as cur:
+                deleted = cur.rowcount
+            await database.commit()
+            if not deleted:  # cancelled while it was waiting to be caught up
+                logger.debug(f"Event #{dbrowid} was already cancelled")
+                return
+        if lag is not None:
+            stats.lag.add(max(lag, 0))
+            if lag >= lag_warning_threshold:
+                logger.warning(f"event #{dbrowid} ({eventtype}) started {lag:.1f}s late")
         if eventtype == "debug":
             logger.debug("Hello world! (debug event)")
         elif eventtype == "message":
@@ -99,19 +291,17 @@ async def run_event(dbrowid, eventtype: str, eventdata: dict):
                                  modlog.modlog(f"{member.mention}'s (`{member}`) "
                                                f"thin ice has expired.", guild.id, member.id))
             await database.db.execute("DELETE FROM thin_ice WHERE guild=? and user=?", (guild.id, member.id))
-            await database.db.commit()
+            await database.commit()
         elif eventtype == "birthday":
             now = datetime.now(tz=timezone.utc)
             birthday = datetime.fromtimestamp(eventdata["birthday"], tz=timezone.utc)
             age = round((now - birthday).days / 365.25)
             createdchannels = []
             for guild in botcopy.guilds:
-                async with database.db.execute("SELECT birthday_category FROM server_config WHERE guild=?",
-                                               (guild.id,)) as cur:
-                    bcategory = await cur.fetchone()
+                bcategory = (await serverconfig.get(guild.id)).birthday_category
                 if bcategory is not None:
                     member = guild.get_member(eventdata["user"])
-                    bcategoryreal: discord.CategoryChannel = guild.get_channel(bcategory[0])
+                    bcategoryreal: discord.CategoryChannel = guild.get_channel(bcategory)
                     if bcategoryreal is not None and member is not None:
                         dname = ''.join(c for c in member.display_name.lower() if c.isalnum() or c == "-")
                         bchannel = await bcategoryreal.create_text_channel(f"🎂{dname}-birthday"[:32],
@@ -141,31 +331,47 @@ async def run_event(dbrowid, eventtype: str, eventdata: dict):
             logger.error(f"Unknown event type {eventtype} for event {dbrowid}")
 
     except Exception as e:
+        stats.failed += 1
+        stats.duration.add(perf_counter() - start)
         logger.error(e, exc_info=(type(e), e, e.__traceback__))
+    else:
+        stats.succeeded += 1
+        stats.duration.add(perf_counter() - start)
 
 
 async def schedule(time: datetime, eventtype: str, eventdata: dict):
     assert time.tzinfo is not None  # offset aware datetimes my beloved
     if time <= datetime.now(tz=timezone.utc):
         logger.debug(f"running event now")
-        await run_event(None, eventtype, eventdata)
+        await run_event(None, eventtype, eventdata, time)
+        return None
 
-    async with database.db.execute("INSERT INTO schedule (eventtime, eventtype, eventdata) VALUES (?,?,?)",
-                                   (time.timestamp(), eventtype, json.dumps(eventdata))) as cursor:
+    async with database.db.execute("INSERT INTO schedule (eventtime, eventtype, eventdata, guild, member, user) "
+                                   "VALUES (?,?,?,?,?,?)",
+                                   (time.timestamp(), eventtype, json.dumps(eventdata), eventdata.get("guild"),
+                                    eventdata.get("member"), eventdata.get("user"))) as cursor:
         lri = cursor.lastrowid
-        task = scheduler.schedule(run_event(lri, eventtype, eventdata), time)
-        loadedtasks[lri] = task
+    # anything past the horizon just sits in the db until the refill task gets to it
+    if loaded_until is not None and time <= loaded_until and lri not in loadedtasks:
+        task = scheduler.schedule(run_event(lri, eventtype, eventdata, time), time)
+        _track(lri, task, eventtype, eventdata)
         logger.debug(f"scheduled event #{lri} for {time}")
-        # logger.debug(loadedtasks)
-    await database.db.commit()
+    else:
+        logger.debug(f"stored event #{lri} for {time}")
+    await database.commit()
     return lri
 
 
 async def canceltask(dbrowid: int):
-    scheduler.cancel(loadedtasks[dbrowid])
+    # events past the horizon aren't loaded, those only need deleting from the db
+    task = loadedtasks.get(dbrowid)
+    # out of the indexes first so nothing else finds it and tries to cancel it again while we wait on the db
+    _untrack(dbrowid)
+    if task is not None:
+        scheduler.cancel(task)
     await database.db.execute("DELETE FROM schedule WHERE id=?", (dbrowid,))
-    await database.db.commit()
-    # it throws a runtime warning "coroutine was never ran" like no shit that is the entire idea
-    loadedtasks[dbrowid].callback.close()
-    del loadedtasks[dbrowid]
+    await database.commit()
+    if task is not None:
+        # it throws a runtime warning "coroutine was never ran" like no shit that is the entire idea
+        task.callback.close()
     logger.debug(f"Cancelled task {dbrowid}")
@@ -0,0 +1,61 @@
+import dataclasses
+import typing
+
+import database
+
+
+@dataclasses.dataclass
+class ServerConfig:
+    """one row of server_config. every column is None if the guild never set it."""
+    guild: int
+    mod_role: typing.Optional[int] = None
+    log_channel: typing.Optional[int] = None
+    ban_appeal_link: typing.Optional[str] = None
+    thin_ice_role: typing.Optional[int] = None
+    thin_ice_threshold: typing.Optional[int] = None
+    birthday_category: typing.Optional[int] = None
+    booster_roles: typing.Optional[bool] = None
+    booster_role_hoist: typing.Optional[int] = None
+    bulk_log_channel: typing.Optional[int] = None
+    time_between_xp: typing.Optional[float] = None
+    xp_change_per_level: typing.Optional[float] = None
+    verification_channel: typing.Optional[int] = None
+    verified_role: typing.Optional[int] = None
+    verification_text: typing.Optional[str] = None
+
+
+# the names of every column, in table order. also doubles as a whitelist since column names get put in f-strings.
+columns = tuple(field.name for field in dataclasses.fields(ServerConfig))
+# guild id -> config. guilds with no row are cached too (as all None) so they dont hit the db every message
+configs: dict[int, ServerConfig] = {}
+
+
+async def get(guild: int) -> ServerConfig:
+    """get a guild's config, loading it from the db the first time it's asked for"""
+    conf = configs.get(guild)
+    if conf is None:
+        async with database.db.execute(f"SELECT {','.join(columns)} FROM server_config WHERE guild=?",
+                                       (guild,)) as cur:
+            row = await cur.fetchone()
+        conf = ServerConfig(*row) if row is not None else ServerConfig(guild)
+        configs[guild] = conf
+    return conf
+
+
+async def update(guild: int, column: str, value):
+    """write a single column to the db and the cache at the same time"""
+    assert column in columns and column != "guild", f"{column} is not a server_config column"
+    async with database.db.execute("SELECT COUNT(guild) FROM server_config WHERE guild=?", (guild,)) as cur:
+        guilds = await cur.fetchone()
+    if guilds[0]:  # if there already is a row for this guild
+        await database.db.execute(f"UPDATE server_config SET {column} = ? WHERE guild=?", (value, guild))
+    else:  # if not, make one
+        await database.db.execute(f"INSERT INTO server_config(guild, {column}) VALUES (?, ?)", (guild, value))
+    await database.commit()
+    if guild in configs:
+        setattr(configs[guild], column, value)
+
+
+def invalidate(guild: int):
+    """forget a guild's cached config. use after writing to server_config without going through update()"""
+    configs.pop(guild, None)
@@ -1,13 +1,13 @@
 import asyncio
-import datetime
-import itertools
+import bisect
+import collections
+import dataclasses
+import heapq
 import math
-import operator
 import sys
+import time
 import typing
-from collections import defaultdict
 
-import aiosqlite
 import discord
 import si_prefix
 from discord.ext import commands
@@ -16,8 +16,33 @@ from discord.ext.commands import BucketType
 import database
 import moderation
 import modlog
+import serverconfig
+import xpengine
 from clogs import logger
 
+# XP gained from messages is written to the db at least this often, in seconds...
+xp_flush_interval = 15
+# ...or as soon as this many users have some waiting
+xp_flush_size = 1000
+# XP recalculation: how many history requests can be in flight at once...
+crawl_concurrency = 8
+# ...how many pages each channel can fetch ahead of the merge...
+crawl_prefetch_pages = 2
+# ...how many times to retry a page that got a 429 or a discord server error...
+crawl_max_retries = 5
+# ...how often to update the progress message, in seconds...
+crawl_progress_interval = 5
+# ...how often to refresh the status it and recalcstatus show, in seconds...
+recalc_status_interval = 1
+# ...and how often to save progress so a restart can pick up where it left off, in seconds
+recalc_checkpoint_interval = 30
+# how many guilds to keep a RankIndex for. the least recently used one is dropped past this
+rank_index_guilds = 64
+# how many users go in each of a RankIndex's sorted buckets, a bucket gets split in two at twice this
+rank_bucket_size = 512
+# how often to drop XP cooldowns that have run out, in seconds
+cooldown_evict_interval = 60 * 5
+
 
 def progress_bar(n: typing.Union[int, float], tot: typing.Union[int, float], cols: int = 20, border: str = "") -> str:
     """
@@ -54,43 +79,424 @@ def xp_to_level(xp: float, xp_per_level: float):
                       + sys.float_info.epsilon)
 
 
-async def sort_messages_in_channel(channel: discord.abc.Messageable):
-    out = defaultdict(list)
-    try:
-        async for msg in channel.history(limit=None, oldest_first=True):
-            if not msg.author.bot:
-                out[msg.author.id].append(msg.created_at)
-    except discord.Forbidden:
-        pass
-    return out
+class HistoryCrawler:
+    """
+    reads the history of many channels at once, a page at a time, oldest first, with at most `concurrency` requests
+    in flight. discord.py already waits out the per-route rate limit buckets, this backs off and retries when a 429
+    gets through anyway. each channel fetches a few pages ahead into a bounded queue so memory stays flat.
+    """
 
+    def __init__(self, concurrency: int = crawl_concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # one stream per channel for merge_messages(), and the id of the channel behind each one
+        self.streams: list[typing.AsyncIterator[tuple[float, int, int]]] = []
+        self.channels: list[int] = []
+        self.tasks: list[asyncio.Task] = []
+        self.channel_ids: set[int] = set()
+        self.channels_done = 0
+        self.messages = 0
+        self.started = time.perf_counter()
 
-dict_of_lists = dict[typing.Any, list]
+    def add(self, channel: discord.abc.Messageable, after: typing.Optional[int] = None):
+        """
+        start crawling a channel. adding the same channel twice does nothing
+        :param channel: channel or thread to read
+        :param after: only read messages after this message id, to resume a crawl
+        """
+        if channel.id in self.channel_ids:
+            return
+        self.channel_ids.add(channel.id)
+        self.channels.append(channel.id)
+        queue = asyncio.Queue(crawl_prefetch_pages)
+        self.tasks.append(asyncio.create_task(self._crawl(channel, queue, after)))
+        self.streams.append(self._drain(queue))
 
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
 
-def lodoltdol(inp: list[dict_of_lists]) -> dict_of_lists:
-    # list_of_dicts_of_lists_to_dict_of_lists
-    # https://stackoverflow.com/a/54108746/9044183
-    # initialise defaultdict of lists
-    dd = defaultdict(list)
+    def progress(self) -> str:
+        rate = self.messages / max(time.perf_counter() - self.started, 1e-9)
+        return f"{self.channels_done}/{len(self.channel_ids)} channels, {self.messages:,} messages ({rate:,.0f}/s)"
 
-    # iterate dictionary items
-    dict_items = map(operator.methodcaller('items'), inp)
-    for k, v in itertools.chain.from_iterable(dict_items):
-        dd[k].extend(v)
-    return dd
+    async def _fetch_page(self, channel: discord.abc.Messageable, after: typing.Optional[discord.abc.Snowflake]) \
+            -> list[discord.Message]:
+        for attempt in range(crawl_max_retries + 1):
+            try:
+                async with self.semaphore:
+                    return [msg async for msg in channel.history(limit=100, after=after, oldest_first=True)]
+            except (discord.Forbidden, discord.NotFound):
+                raise
+            except discord.HTTPException as e:
+                if (e.status == 429 or e.status >= 500) and attempt < crawl_max_retries:
+                    logger.warning(f"got {e.status} reading {channel.id}, retrying in {2 ** attempt}s")
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    raise
 
+    async def _crawl(self, channel: discord.abc.Messageable, queue: asyncio.Queue, after: typing.Optional[int]):
+        try:
+            after = discord.Object(after) if after is not None else None
+            while True:
+                page = await self._fetch_page(channel, after)
+                self.messages += len(page)
+                await queue.put([(msg.created_at.timestamp(), msg.author.id, msg.id)
+                                 for msg in page if not msg.author.bot])
+                if len(page) < 100:
+                    break
+                after = page[-1]
+        except (discord.Forbidden, discord.NotFound):
+            # can't read it or it was deleted mid-crawl, count what we got and move on
+            pass
+        except Exception as e:
+            # handed to whoever is reading the stream
+            await queue.put(e)
+            return
+        self.channels_done += 1
+        await queue.put(None)
+
+    @staticmethod
+    async def _drain(queue: asyncio.Queue) -> typing.AsyncIterator[tuple[float, int, int]]:
+        while (page := await queue.get()) is not None:
+            if isinstance(page, Exception):
+                raise page
+            for message in page:
+                yield message
+
+
+async def merge_messages(iterators: list[typing.AsyncIterator[tuple[float, int, int]]]) \
+        -> typing.AsyncIterator[tuple[int, tuple[float, int, int]]]:
+    """
+    k-way merge of already sorted message streams into one sorted stream. only holds the head of each stream, so
+    memory depends on the number of streams and not the number of messages.
+    :param iterators: async iterators of (timestamp, author id, message id), each oldest first
+    :return: async iterator of (index of the stream it came from, (timestamp, author id, message id)), oldest first
+    across all of them
+    """
+    # (timestamp, index of iterator, message). the index breaks ties so the rest never gets compared
+    heap = []
+    for i, iterator in enumerate(iterators):
+        first = await anext(iterator, None)
+        if first is not None:
+            heap.append((first[0], i, first))
+    heapq.heapify(heap)
+    while heap:
+        _, i, message = heap[0]
+        yield i, message
+        following = await anext(iterators[i], None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (following[0], i, following))
+
+
+class XPCounter:
+    """
+    recounts XP from a guild's history the same way on_message gives it out, one message at a time, each user's
+    messages oldest first. only 2 numbers per user are kept, never the messages themselves, so memory stays O(users)
+    however much history there is. this is recalculateguildxp's counting, and what xpbench times.
+    """
+
+    def __init__(self, timeout: float, excluded: typing.Collection[int] = (), xps: dict[int, int] = None,
+                 last_xp_gain: dict[int, float] = None):
+        """
+        :param timeout: seconds between XP gains
+        :param excluded: user ids that can't gain XP
+        :param xps: user id -> XP so far, to pick up from a checkpoint
+        :param last_xp_gain: user id -> timestamp of the message that last gave them XP, to pick up from a checkpoint
+        """
+        self.timeout = timeout
+        self.excluded = excluded
+        self.xps: dict[int, int] = {} if xps is None else xps
+        self.last_xp_gain: dict[int, float] = {} if last_xp_gain is None else last_xp_gain
+
+    def count(self, user: int, timestamp: float) -> bool:
+        """
+        :param user: author of the message
+        :param timestamp: when it was sent, epoch seconds
+        :return: if it gained XP
+        """
+        if user in self.excluded:
+            return False
+        last = self.last_xp_gain.get(user)
+        if last is None or timestamp - last >= self.timeout:
+            self.xps[user] = self.xps.get(user, 0) + 1
+            self.last_xp_gain[user] = timestamp
+            return True
+        return False
+
+
+class CooldownStore:
+    """
+    when each user last gained XP in each guild, as float epoch seconds. keyed by user and guild packed into one int so
+    a lookup doesn't format a string. entries that are older than their guild's cooldown can't stop anyone gaining XP
+    anymore, evict() drops them so this only holds users who were active recently.
+    """
+
+    def __init__(self):
+        self.last: dict[int, float] = {}
+
+    @staticmethod
+    def key(user: int, guild: int) -> int:
+        # snowflakes are 64 bit
+        return user << 64 | guild
+
+    def __len__(self):
+        return len(self.last)
+
+    def get(self, user: int, guild: int) -> typing.Optional[float]:
+        return self.last.get(self.key(user, guild))
+
+    def record(self, user: int, guild: int, timestamp: float):
+        self.last[self.key(user, guild)] = timestamp
+
+    def evict(self, cooldowns: dict[int, float], now: float) -> int:
+        """
+        drop every entry whose cooldown has run out
+        :param cooldowns: guild id -> cooldown in seconds. guilds not in here are kept
+        :param now: current epoch time
+        :return: how many entries were dropped
+        """
+        before = len(self.last)
+        mask = (1 << 64) - 1
+        self.last = {key: timestamp for key, timestamp in self.last.items()
+                     if now - timestamp < cooldowns.get(key & mask, math.inf)}
+        return before - len(self.last)
+
+    def guilds(self) -> set[int]:
+        mask = (1 << 64) - 1
+        return {key & mask for key in self.last}
+
+
+class RankIndex:
+    """
+    every user's XP in one guild, kept sorted so rank, top XP and leaderboard pages don't sort the whole guild each
+    time. the sorted entries are split into buckets of up to 2 * rank_bucket_size, so an update is a bisect plus a
+    list insert/delete within one bucket instead of shifting the whole guild, and finding a rank adds up the bucket
+    lengths before it. both are O(sqrt n)-ish, a few microseconds even for 100k+ users.
+    """
+
+    def __init__(self, rows: typing.Iterable[tuple[int, float]]):
+        self.xp: dict[int, float] = dict(rows)
+        # (-xp, user) so it goes highest XP first, ties in user id order
+        order = sorted((-xp, user) for user, xp in self.xp.items())
+        self.buckets: list[list[tuple[float, int]]] = [order[i:i + rank_bucket_size]
+                                                       for i in range(0, len(order), rank_bucket_size)]
+        # last entry of each bucket, to find which bucket an entry belongs in
+        self.maxes: list[tuple[float, int]] = [bucket[-1] for bucket in self.buckets]
+
+    def __len__(self):
+        return len(self.xp)
+
+    def _insert(self, entry: tuple[float, int]):
+        if not self.buckets:
+            self.buckets.append([entry])
+            self.maxes.append(entry)
+            return
+        # past the end of the last bucket still goes in the last bucket
+        b = min(bisect.bisect_left(self.maxes, entry), len(self.buckets) - 1)
+        bucket = self.buckets[b]
+        bisect.insort(bucket, entry)
+        if len(bucket) > 2 * rank_bucket_size:
+            self.buckets[b:b + 1] = [bucket[:rank_bucket_size], bucket[rank_bucket_size:]]
+            self.maxes[b:b + 1] = [bucket[rank_bucket_size - 1], bucket[-1]]
+        else:
+            self.maxes[b] = bucket[-1]
+
+    def _delete(self, entry: tuple[float, int]):
+        b = bisect.bisect_left(self.maxes, entry)
+        bucket = self.buckets[b]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if bucket:
+            self.maxes[b] = bucket[-1]
+        else:
+            del self.buckets[b]
+            del self.maxes[b]
 
-def list_of_datetimes_to_xp(inp: list[datetime.datetime], time_between_xp: float) -> int:
-    xp = 0
-    inp = sorted(inp)
-    # just some random old date
-    last_xp_gain = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
-    for msg in inp:
-        if (msg - last_xp_gain).total_seconds() >= time_between_xp:
-            xp += 1
-            last_xp_gain = msg
-    return xp
+    def remove(self, user: int):
+        xp = self.xp.pop(user, None)
+        if xp is not None:
+            self._delete((-xp, user))
+
+    def add(self, user: int, delta: float):
+        xp = self.xp.get(user, 0) + delta
+        self.remove(user)
+        self.xp[user] = xp
+        self._insert((-xp, user))
+
+    def rank_of_xp(self, xp: float) -> int:
+        """same as sql's RANK(): 1 + how many users have more XP, so ties share a rank"""
+        # (-xp,) sorts before every (-xp, user)
+        key = (-xp,)
+        b = bisect.bisect_left(self.maxes, key)
+        before = sum(len(bucket) for bucket in self.buckets[:b])
+        if b < len(self.buckets):
+            before += bisect.bisect_left(self.buckets[b], key)
+        return before + 1
+
+    def rank(self, user: int) -> typing.Optional[tuple[float, int]]:
+        """
+        :return: (xp, rank) of a user, None if they have no XP in this guild
+        """
+        xp = self.xp.get(user)
+        if xp is None:
+            return None
+        return xp, self.rank_of_xp(xp)
+
+    def top(self) -> typing.Optional[float]:
+        return -self.buckets[0][0][0] if self.buckets else None
+
+    def page(self, start: int, count: int) -> list[tuple[int, float, int]]:
+        """
+        :return: (user, xp, rank) of `count` users, starting from the `start`th highest
+        """
+        entries = []
+        skip = start
+        for bucket in self.buckets:
+            if skip >= len(bucket):
+                skip -= len(bucket)
+                continue
+            entries += bucket[skip:skip + count - len(entries)]
+            skip = 0
+            if len(entries) == count:
+                break
+        rows = []
+        prevxp, rank = None, None
+        for position, (negxp, user) in enumerate(entries, start + 1):
+            # only the first one needs looking up, after that a user ties the one before or is ranked by position
+            if prevxp is None:
+                rank = self.rank_of_xp(-negxp)
+            elif negxp != prevxp:
+                rank = position
+            prevxp = negxp
+            rows.append((user, -negxp, rank))
+        return rows
+
+
+# where a leaderboard page ends: (xp, user, rank, how many users are on it and every page before it)
+LeaderboardCursor = tuple[float, int, int, int]
+
+
+async def leaderboard_page(guild: int, after: typing.Optional[LeaderboardCursor], count: bool = False) \
+        -> tuple[list[tuple[int, float, int]], typing.Optional[float], typing.Optional[int]]:
+    """
+    one leaderboard page from the db in one query. seeks past the end of the page before through the
+    (guild, experience DESC, user) index instead of using OFFSET, so every page costs the same, and carries the rank
+    forward from it instead of computing RANK() over the whole guild.
+    :param guild: guild id
+    :param after: cursor of the page before, None for the first page
+    :param count: also count the users in the guild. that's the one part that reads the whole guild, so only ask
+        when there's no number to reuse
+    :return: ((user, xp, rank) for up to 10 users, top xp in the guild, number of users in the guild or None if
+        count is false)
+    """
+    # written so sqlite can range seek the index on experience <= ?, the more obvious
+    # "experience < ? OR (experience = ? AND user > ?)" makes it walk every row of the guild before the cursor
+    seek = "" if after is None else "AND experience <= ? AND (experience < ? OR user > ?)"
+    total = "(SELECT COUNT(*) FROM experience WHERE guild=?)" if count else "NULL"
+    async with database.read(f"SELECT stats.top, stats.total, page.user, page.experience "
+                             f"FROM (SELECT (SELECT MAX(experience) FROM experience WHERE guild=?) AS top, "
+                             f"             {total} AS total) stats "
+                             f"LEFT JOIN (SELECT user, experience FROM experience WHERE guild=? {seek} "
+                             f"           ORDER BY experience DESC, user LIMIT 10) page ON true "
+                             f"ORDER BY page.experience DESC, page.user",
+                             (guild,) + ((guild,) if count else ()) + (guild,)
+                             + (() if after is None else (after[0], after[0], after[1]))) as cur:
+        result = await cur.fetchall()
+    prevxp, rank, position = (None, None, 0) if after is None else (after[0], after[2], after[3])
+    rows = []
+    for _, _, user, xp in result:
+        if user is None:  # no users on this page, the LEFT JOIN still gives one row for the stats
+            continue
+        position += 1
+        if xp != prevxp:
+            rank = position
+        prevxp = xp
+        rows.append((user, xp, rank))
+    return rows, result[0][0], result[0][1]
+
+
+class LeaderboardView(discord.ui.View):
+    """previous/next buttons for the leaderboard command"""
+
+    def __init__(self, cog: "ExperienceCog", ctx: commands.Context):
+        super().__init__(timeout=60 * 5)
+        self.cog = cog
+        self.ctx = ctx
+        self.page = 1
+        self.rows: list[tuple[int, float, int]] = []
+        self.top: typing.Optional[float] = None
+        # counted once when the view opens and kept for every page after, unless the guild's RankIndex is warm
+        self.total: typing.Optional[int] = None
+        # page -> cursor of the page before it, for every page we know how to seek to
+        self.cursors: dict[int, LeaderboardCursor] = {}
+
+    async def load(self, page: int):
+        """fetch a page and remember where it ends so the next one can seek from there"""
+        guild = self.ctx.guild.id
+        await self.cog.flush_xp(guild)
+        index = self.cog.rank_indexes.get(guild)
+        if index is None and page != 1 and page not in self.cursors:
+            # a jump with nothing to seek from. load the guild's RankIndex once rather than OFFSET through the table
+            index = await self.cog.get_rank_index(guild)
+        if index is not None:
+            self.rows = index.page((page - 1) * 10, 10)
+            self.top, self.total = index.top(), len(index)
+        else:
+            self.rows, self.top, total = await leaderboard_page(guild, self.cursors.get(page), self.total is None)
+            if total is not None:
+                self.total = total
+        self.page = page
+        if self.rows:
+            user, xp, rank = self.rows[-1]
+            self.cursors[page + 1] = (xp, user, rank, (page - 1) * 10 + len(self.rows))
+        self.previous.disabled = page == 1
+        self.next.disabled = page * 10 >= self.total
+
+    async def embed(self) -> discord.Embed:
+        embed = discord.Embed(color=discord.Color(0x15fe02), title=self.ctx.guild.name,
+                              description=f"Page {self.page}")
+        embed.set_thumbnail(url=self.ctx.guild.icon.url)
+        if self.rows:
+            # get guild xp settings
+            change_per_level = (await serverconfig.get(self.ctx.guild.id)).xp_change_per_level
+            if change_per_level is None:
+                # default
+                change_per_level = 30
+            # format leaderboard
+            text = ""
+            for row in self.rows:
+                user, experience, rank = row
+                text += f"**#{rank}** <@{user}>\n" \
+                        f"Level **{xp_to_level(experience, change_per_level)}** " \
+                        f"`{progress_bar(experience, self.top, 20)}` " \
+                        f"**{si_prefix.si_prefix(experience)}** XP\n"
+            embed.add_field(name="Leaderboard", value=text)
+        else:
+            embed.add_field(name="No users found!",
+                            value="Try going back a page and making sure experience is enabled in this server")
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.ctx.author.id
+
+    @discord.ui.button(label="Previous", emoji="⬅️", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.load(self.page - 1)
+        await interaction.response.edit_message(embed=await self.embed(), view=self)
+
+    @discord.ui.button(label="Next", emoji="➡️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.load(self.page + 1)
+        await interaction.response.edit_message(embed=await self.embed(), view=self)
+
+
+@dataclasses.dataclass
+class RecalcJob:
+    """a running XP recalculation. everything needed to resume it lives in the xp_recalc_* tables, not here"""
+    task: typing.Optional[asyncio.Task] = None
+    # human readable progress for recalcstatus and the progress message
+    status: str = "Starting..."
 
 
 class ExperienceCog(commands.Cog, name="Experience"):
@@ -98,11 +504,118 @@ class ExperienceCog(commands.Cog, name="Experience"):
     def __init__(self, bot):
         self.bot: commands.Bot = bot
         # var and not db for performance and cause it doesnt really matter if its lost
-        self.last_message_in_guild = {
-            "user.guild": "datetime object"
-        }
+        self.last_xp_gain = CooldownStore()
         # suspend XP gain for recalculation
         self.suspended_guild = []
+        # guild id -> ids of users and channels that can't gain XP there. loaded the first time a guild needs it and
+        # kept up to date by excludefromxp and togglemyxp so on_message never has to ask the db
+        self.exclusions: dict[int, set[int]] = {}
+        # (user, guild) -> XP gained since the last flush. on_message only adds to this, flush_xp() writes it out
+        self.pending_xp: dict[tuple[int, int], int] = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task: typing.Optional[asyncio.Task] = None
+        self.evict_task: typing.Optional[asyncio.Task] = None
+        # guild id -> XP recalculation running for it
+        self.recalc_jobs: dict[int, RecalcJob] = {}
+        # guild id -> RankIndex, least recently used first. always matches the experience table, see get_rank_index()
+        self.rank_indexes: collections.OrderedDict[int, RankIndex] = collections.OrderedDict()
+
+    async def cog_load(self):
+        self.flush_task = asyncio.create_task(self.flush_xp_loop())
+        self.evict_task = asyncio.create_task(self.evict_cooldowns_loop())
+        xpengine.prune_snapshots()
+        # pick up recalculations that were running when the bot went down
+        async with database.db.execute("SELECT guild FROM xp_recalc_jobs") as cur:
+            for row in await cur.fetchall():
+                logger.info(f"resuming XP recalculation for guild {row[0]}")
+                self.start_recalc(row[0])
+
+    async def cog_unload(self):
+        # recalculations stop where they are and resume from their last checkpoint next time
+        for job in self.recalc_jobs.values():
+            job.task.cancel()
+        self.evict_task.cancel()
+        # the bot removes every cog when it closes, so this is the last chance to save pending XP
+        self.flush_task.cancel()
+        await self.flush_xp()
+
+    async def flush_xp_loop(self):
+        while True:
+            await asyncio.sleep(xp_flush_interval)
+            try:
+                await self.flush_xp()
+            except Exception as e:
+                logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+    async def evict_cooldowns_loop(self):
+        while True:
+            await asyncio.sleep(cooldown_evict_interval)
+            try:
+                cooldowns = {}
+                for guild in self.last_xp_gain.guilds():
+                    # same default as on_message
+                    cooldowns[guild] = (await serverconfig.get(guild)).time_between_xp or 60
+                evicted = self.last_xp_gain.evict(cooldowns, time.time())
+                logger.debug(f"evicted {evicted} XP cooldown(s), {len(self.last_xp_gain)} left")
+            except Exception as e:
+                logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+    async def flush_xp(self, guild: typing.Optional[int] = None):
+        """
+        write pending XP to the db in one statement and commit it. once this returns, the XP pending when it was
+        called can be read back, even if another flush was already halfway through.
+        :param guild: only flush this guild's pending XP. None for every guild.
+        """
+        async with self.flush_lock:
+            if guild is None:
+                pending, self.pending_xp = self.pending_xp, {}
+            else:
+                pending = {key: xp for key, xp in self.pending_xp.items() if key[1] == guild}
+                for key in pending:
+                    del self.pending_xp[key]
+            if not pending:
+                return
+            try:
+                await database.db.executemany("INSERT INTO experience(user, guild, experience) VALUES (?,?,?) "
+                                              "ON CONFLICT(user, guild) "
+                                              "DO UPDATE SET experience = experience + excluded.experience",
+                                              [(user, g, xp) for (user, g), xp in pending.items()])
+            except Exception:
+                # put it back for the next flush
+                for key, xp in pending.items():
+                    self.pending_xp[key] = self.pending_xp.get(key, 0) + xp
+                raise
+            try:
+                await database.commit()
+            except Exception:
+                # the rows are still in the writer's open transaction and may or may not land with a later commit, so
+                # the cached indexes can't know either way. reload them from the db next time
+                for g in {g for _, g in pending}:
+                    self.rank_indexes.pop(g, None)
+                raise
+            for (user, g), xp in pending.items():
+                index = self.rank_indexes.get(g)
+                if index is not None:
+                    index.add(user, xp)
+            logger.debug(f"flushed XP for {len(pending)} user(s)")
+
+    async def get_exclusions(self, guild: int) -> set[int]:
+        """
+        get the set of excluded users and channels for a guild, loading it the first time
+        :param guild: guild id
+        :return: set of user and channel ids
+        """
+        excl = self.exclusions.get(guild)
+        if excl is None:
+            async with database.read("SELECT userorchannel FROM guild_xp_exclusions WHERE guild=?", (guild,)) as cur:
+                excl = {row[0] for row in await cur.fetchall()}
+            self.exclusions[guild] = excl
+        return excl
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        # nobody is going to xpwhatif a guild we're not in
+        xpengine.delete_snapshot(guild.id)
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -116,115 +629,346 @@ class ExperienceCog(commands.Cog, name="Experience"):
             return
 
         # we dont care how long the timeout is if there is no entry for last message
-        if f"{message.author.id}.{message.guild.id}" in self.last_message_in_guild:
-            # get timeout between message for this guild
-            async with database.db.execute("SELECT time_between_xp FROM server_config WHERE guild=?",
-                                           (message.guild.id,)) as cur:
-                cur: aiosqlite.Cursor
-                timeout = await cur.fetchone()
-            if timeout and timeout[0]:
-                timeout = timeout[0]
-            else:  # sensible default
+        last = self.last_xp_gain.get(message.author.id, message.guild.id)
+        if last is not None:
+            # get timeout between message for this guild. cached by serverconfig, and xpcooldown updates the cache
+            timeout = (await serverconfig.get(message.guild.id)).time_between_xp
+            if not timeout:  # sensible default
                 timeout = 60
             # make sure the minimum timeout has passed
-            sincelastmsg = discord.utils.utcnow() - self.last_message_in_guild[f"{message.author.id}."
-                                                                               f"{message.guild.id}"]
-            if sincelastmsg.total_seconds() < timeout:
-                logger.debug(f"{message.author} has to wait {round(timeout - sincelastmsg.total_seconds(), 1):g}s"
+            sincelastmsg = time.time() - last
+            if sincelastmsg < timeout:
+                logger.debug(f"{message.author} has to wait {round(timeout - sincelastmsg, 1):g}s"
                              f" before gaining XP again in {message.guild}.")
                 return
         # check if user or channel is excluded from gaining XP
-        async with database.db.execute("SELECT userorchannel FROM guild_xp_exclusions WHERE guild=?",
-                                       (message.guild.id,)) as cur:
-            cur: aiosqlite.Cursor
-            async for row in cur:
-                excl = row[0]
-                if message.channel.id == excl or message.author.id == excl:
-                    logger.debug(f"{message.author} tried to gain XP as an excluded user or in an excluded channel"
-                                 f" in {message.guild}. Exclusion is {excl}.")
-                    return
-        # create new record of 1 xp or update by 1
-        await database.db.execute("""INSERT INTO experience(user, guild, experience) VALUES (?,?,1)
-                            ON CONFLICT(user, guild) DO UPDATE SET experience = experience + 1;""",
-                                  (message.author.id, message.guild.id))
-        await database.db.commit()
-        self.last_message_in_guild[f"{message.author.id}.{message.guild.id}"] = message.created_at
+        excl = await self.get_exclusions(message.guild.id)
+        if message.channel.id in excl or message.author.id in excl:
+            logger.debug(f"{message.author} tried to gain XP as an excluded user or in an excluded channel"
+                         f" in {message.guild}.")
+            return
+        # add 1 xp, it gets written to the db with everyone else's by flush_xp()
+        key = (message.author.id, message.guild.id)
+        self.pending_xp[key] = self.pending_xp.get(key, 0) + 1
+        if len(self.pending_xp) >= xp_flush_size and not self.flush_lock.locked():
+            asyncio.create_task(self.flush_xp())
+        self.last_xp_gain.record(message.author.id, message.guild.id, message.created_at.timestamp())
         logger.debug(f"{message.author} gained XP in {message.guild}")
 
-    @commands.command()
-    @commands.has_permissions(manage_guild=True)
-    @commands.cooldown(1, 60 * 60 * 24 * 7, BucketType.guild)
-    async def recalculateguildxp(self, ctx: commands.Context):
+    async def get_rank_index(self, guild: int) -> RankIndex:
+        """get a guild's RankIndex, loading it from the db if it isn't cached"""
+        index = self.rank_indexes.get(guild)
+        if index is None:
+            # flushes update cached indexes, so hold them off until this one is cached too or it could miss one
+            async with self.flush_lock:
+                index = self.rank_indexes.get(guild)
+                if index is None:
+                    async with database.db.execute("SELECT user, experience FROM experience WHERE guild=?",
+                                                   (guild,)) as cur:
+                        index = RankIndex(await cur.fetchall())
+                    self.rank_indexes[guild] = index
+                    while len(self.rank_indexes) > rank_index_guilds:
+                        self.rank_indexes.popitem(last=False)
+        self.rank_indexes.move_to_end(guild)
+        return index
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def xpcachestats(self, ctx: commands.Context):
         """
-        recalculate guild's XP from message history
+        show how much the XP system is holding in memory
         """
-        async with ctx.typing():
-            # get text channels and active threads
-            channels = set(ctx.guild.text_channels + list(ctx.guild.threads))
-            # GATHER CAN CAUSE 429s NEVER AGAIN
-            # prvget = [channel.archived_threads(private=True, joined=True, limit=None).flatten() for channel in
-            #           ctx.guild.text_channels]
-            # pubget = [channel.archived_threads(limit=None).flatten() for channel in
-            #           ctx.guild.text_channels]
-            # list_of_lists_of_athreads = await asyncio.gather(*(prvget + pubget), return_exceptions=True)
-            # # some might error but just ignore them frfr
-            # channels += list(sum([l for l in list_of_lists_of_athreads if isinstance(l, list)], []))
-            for channel in ctx.guild.text_channels:
+        await ctx.reply(f"```XP cooldowns:        {len(self.last_xp_gain):,} "
+                        f"across {len(self.last_xp_gain.guilds()):,} guild(s)\n"
+                        f"pending XP:          {len(self.pending_xp):,} user(s)\n"
+                        f"rank indexes:        {len(self.rank_indexes)} guild(s), "
+                        f"{sum(len(index) for index in self.rank_indexes.values()):,} user(s)\n"
+                        f"exclusion sets:      {len(self.exclusions)} guild(s)\n"
+                        f"recalculations:      {len(self.recalc_jobs)}```")
+
+    def start_recalc(self, guild: int):
+        job = RecalcJob()
+        self.recalc_jobs[guild] = job
+        job.task = asyncio.create_task(self.run_recalc(guild, job))
+
+    async def find_recalc_channels(self, guild: discord.Guild, crawler: HistoryCrawler, excl: set[int],
+                                   report_to: discord.abc.Messageable):
+        """add every channel and thread in a guild that isn't excluded to a crawler, archived threads included"""
+        # text channels and active threads can start right away, archived threads get added as they're found
+        for channel in guild.text_channels + list(guild.threads):
+            if channel.id not in excl:
+                crawler.add(channel)
+        for channel in guild.text_channels:
+            try:
+                async for th in channel.archived_threads(private=True, joined=True, limit=None):
+                    if th.id not in excl:
+                        crawler.add(th)
+            except discord.HTTPException as e:
+                await report_to.send(f"{channel.mention} priv: {e}")
                 try:
-                    channels = channels.union(
-                        [th async for th in channel.archived_threads(private=True, joined=True, limit=None)])
+                    async for th in channel.archived_threads(limit=None):
+                        if th.id not in excl:
+                            crawler.add(th)
                 except discord.HTTPException as e:
-                    await ctx.reply(f"{channel.mention} priv: {e}")
+                    await report_to.send(f"{channel.mention} nonpriv: {e}")
+        for channel in guild.forums:
+            try:
+                async for th in channel.archived_threads(limit=None):
+                    if th.id not in excl:
+                        crawler.add(th)
+            except discord.HTTPException as e:
+                await report_to.send(f"{channel.mention} forum: {e}")
+
+    async def checkpoint_recalc(self, guild: int, crawler: HistoryCrawler, positions: dict[int, int],
+                                xps: dict[int, int], last_xp_gain: dict[int, float], changed: set[int],
+                                scanned: int, snapshot_rows: int):
+        """
+        save the channel positions and XP counters that changed since the last checkpoint, all in one commit.
+        snapshot rows have to be on disk already, this only records how many there are.
+        """
+        await database.db.executemany("UPDATE xp_recalc_channels SET last_message=? WHERE guild=? AND channel=?",
+                                      [(message, guild, crawler.channels[i]) for i, message in positions.items()])
+        await database.db.executemany("INSERT OR REPLACE INTO xp_recalc_users(guild, user, experience, last_xp_gain) "
+                                      "VALUES (?,?,?,?)",
+                                      [(guild, user, xps[user], last_xp_gain[user]) for user in changed])
+        await database.db.execute("UPDATE xp_recalc_jobs SET messages=?, snapshot_rows=? WHERE guild=?",
+                                  (scanned, snapshot_rows, guild))
+        await database.commit()
+
+    async def finish_recalc(self, guild: int):
+        """swap the recalculated XP in and delete the job, in one commit"""
+        try:
+            self.suspended_guild.append(guild)
+            # get anything still pending out of the way so it can't land on top of the recalculated XP
+            await self.flush_xp(guild)
+            await database.db.execute("INSERT OR REPLACE INTO experience (user, guild, experience) "
+                                      "SELECT user, guild, experience FROM xp_recalc_users WHERE guild=?", (guild,))
+            await self.delete_recalc(guild)
+            # easier to load it again than to patch it
+            self.rank_indexes.pop(guild, None)
+        finally:
+            self.suspended_guild.remove(guild)
+
+    @staticmethod
+    async def delete_recalc(guild: int):
+        for table in ("xp_recalc_jobs", "xp_recalc_channels", "xp_recalc_users"):
+            await database.db.execute(f"DELETE FROM {table} WHERE guild=?", (guild,))
+        await database.commit()
+
+    async def run_recalc(self, guild_id: int, job: RecalcJob):
+        """
+        run a guild's XP recalculation, or resume it from the last checkpoint in the xp_recalc_* tables.
+        messages are merged oldest first across every channel, so at any point each channel has been read up to some
+        message and every user's XP counts exactly the messages before those. that's what gets checkpointed.
+        """
+        await self.bot.wait_until_ready()
+        crawler = HistoryCrawler()
+        reporter = None
+        report_to = None
+        snapshot = None
+        try:
+            async with database.db.execute("SELECT channel, message, time_between_xp, scanning, messages, "
+                                           "snapshot_rows FROM xp_recalc_jobs WHERE guild=?", (guild_id,)) as cur:
+                report_channel, report_message, timeout, scanning, scanned, snapshot_rows = await cur.fetchone()
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                logger.info(f"dropping XP recalculation for guild {guild_id}, it's gone")
+                await self.delete_recalc(guild_id)
+                return
+            report_to = self.bot.get_partial_messageable(report_channel, guild_id=guild_id)
+            msg = report_to.get_partial_message(report_message)
+
+            async def report_progress():
+                while True:
+                    await asyncio.sleep(crawl_progress_interval)
                     try:
-                        channels = channels.union([ch async for ch in channel.archived_threads(limit=None)])
-                    except discord.HTTPException as e:
-                        await ctx.reply(f"{channel.mention} nonpriv: {e}")
-            for channel in ctx.guild.forums:
-                try:
-                    channels = channels.union([th async for th in channel.archived_threads(limit=None)])
-                except discord.HTTPException as e:
-                    await ctx.reply(f"{channel.mention} forum: {e}")
+                        await msg.edit(content=f"Recalculating XP... {job.status}")
+                    except discord.HTTPException:
+                        pass
+
+            reporter = asyncio.create_task(report_progress())
             # get exclusions and exempt them from scanning
             async with database.db.execute("SELECT userorchannel FROM guild_xp_exclusions WHERE guild=? "
-                                           "AND mod_set=true", (ctx.guild.id,)) as cur:
-                excl = await cur.fetchall()
-            # flatten
-            excl = list(sum(excl, ()))
-            # remove all exclusions
-            channels = [ch for ch in channels if ch.id not in excl]
-        # search all the channels async at once into a list of datetimes of message sent, since thats all we care about
-        msg = await ctx.reply(f"Scanning {len(channels)} channels... this will take a while...")
-        async with ctx.typing():
-            # gather can cause 429s
-            # res = await asyncio.gather(*[sort_messages_in_channel(ch) for ch in channels])
-            res = [await sort_messages_in_channel(ch) for ch in channels]
-        await msg.edit(content="Gathered messages, calculating and setting XP...")
-        async with ctx.typing():
-            async with database.db.execute("SELECT time_between_xp FROM server_config WHERE guild=?",
-                                           (ctx.guild.id,)) as cur:
-                cur: aiosqlite.Cursor
-                timeout = await cur.fetchone()
-            if timeout is None:
-                timeout = 60
+                                           "AND mod_set=true", (guild_id,)) as cur:
+                excl = {row[0] for row in await cur.fetchall()}
+            if scanning:
+                # the channel list is fixed once scanning starts, a channel showing up now would have messages from
+                # before the checkpoint
+                async with database.db.execute("SELECT channel, last_message FROM xp_recalc_channels WHERE guild=?",
+                                               (guild_id,)) as cur:
+                    for channel, last_message in await cur.fetchall():
+                        crawler.add(self.bot.get_partial_messageable(channel, guild_id=guild_id), last_message)
             else:
-                timeout = timeout[0]
-            # flatten indivitual lists from each channel into one big dict
-            res = lodoltdol(res)
-            # calculate xp from lists of message sends and simultaneously do exclusions
-            xps = {k: list_of_datetimes_to_xp(v, timeout) for k, v in res.items() if k not in excl}
-            logger.debug(xps)
+                job.status = "Finding channels..."
+                # the crawl starts as channels are found, the merge waits until the list is complete
+                await self.find_recalc_channels(guild, crawler, excl, report_to)
+                await database.db.executemany("INSERT OR REPLACE INTO xp_recalc_channels(guild, channel) VALUES (?,?)",
+                                              [(guild_id, channel) for channel in crawler.channels])
+                await database.db.execute("UPDATE xp_recalc_jobs SET scanning=true WHERE guild=?", (guild_id,))
+                await database.commit()
+            # every message counted also goes to a snapshot on disk so xpwhatif can try other cooldowns on it later
             try:
-                self.suspended_guild.append(ctx.guild.id)
-                for user, xp in xps.items():
-                    await database.db.execute("INSERT OR REPLACE INTO experience (user, guild, experience) "
-                                              "VALUES (?,?,?)", (user, ctx.guild.id, xp))
-                await database.db.commit()
-                self.suspended_guild.remove(ctx.guild.id)
-            except Exception as e:
-                self.suspended_guild.remove(ctx.guild.id)
-                raise e
-        await ctx.reply(f"Successfully recalculated {sum(xps.values())} XP points for {len(xps)} users!")
-        await msg.delete()
+                snapshot = xpengine.SnapshotWriter(guild_id, snapshot_rows if scanning else 0)
+            except ValueError as e:
+                logger.warning(f"{e}, recalculating without one")
+                xpengine.delete_partial(guild_id)
+            counter = XPCounter(timeout, excl)
+            async with database.db.execute("SELECT user, experience, last_xp_gain FROM xp_recalc_users WHERE guild=?",
+                                           (guild_id,)) as cur:
+                for user, experience, last in await cur.fetchall():
+                    counter.xps[user] = experience
+                    counter.last_xp_gain[user] = last
+            xps, last_xp_gain = counter.xps, counter.last_xp_gain
+            # stream index -> last message counted, and users whose XP changed, since the last checkpoint
+            positions: dict[int, int] = {}
+            changed: set[int] = set()
+            last_checkpoint = last_status = time.perf_counter()
+            # every channel is already oldest first, so merging them gives each user's messages in order and XP can
+            # be counted as they stream past.
+            # this deliberately isn't xpengine.compute_xp(). that needs every message in memory at once (~100 bytes
+            # each at peak, so GBs in the bot process for the guilds big enough to care), it can't checkpoint
+            # partway, and the crawl is what takes the time here anyway, not the counting
+            async for i, (timestamp, user, message) in merge_messages(crawler.streams):
+                positions[i] = message
+                scanned += 1
+                if snapshot is not None:
+                    snapshot.add(user, (message >> 22) + discord.utils.DISCORD_EPOCH)
+                if counter.count(user, timestamp):
+                    changed.add(user)
+                now = time.perf_counter()
+                if now - last_status >= recalc_status_interval:
+                    job.status = f"{scanned:,} messages counted. {crawler.progress()}"
+                    last_status = now
+                if now - last_checkpoint >= recalc_checkpoint_interval:
+                    snapshot_rows = snapshot.write() if snapshot is not None else 0
+                    # shielded so a cancel can't leave half a checkpoint for someone else's commit to pick up
+                    await asyncio.shield(self.checkpoint_recalc(guild_id, crawler, positions, xps, last_xp_gain,
+                                                                changed, scanned, snapshot_rows))
+                    positions, changed = {}, set()
+                    last_checkpoint = time.perf_counter()
+            job.status = "Setting XP..."
+            snapshot_rows = snapshot.write() if snapshot is not None else 0
+            await asyncio.shield(self.checkpoint_recalc(guild_id, crawler, positions, xps, last_xp_gain, changed,
+                                                        scanned, snapshot_rows))
+            await asyncio.shield(self.finish_recalc(guild_id))
+            if snapshot is not None:
+                snapshot.finish()
+                snapshot = None
+                xpengine.prune_snapshots()
+            logger.debug(f"recalculated XP for {guild}: {crawler.progress()}")
+            await report_to.send(f"Successfully recalculated {sum(xps.values())} XP points for {len(xps)} users!")
+            try:
+                await msg.delete()
+            except discord.HTTPException:
+                pass
+        except asyncio.CancelledError:
+            # shutting down (resumes next start) or recalccancel (which deletes the job itself)
+            raise
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+            await self.delete_recalc(guild_id)
+            if snapshot is not None:
+                snapshot.close()
+                snapshot = None
+            xpengine.delete_partial(guild_id)
+            if report_to is not None:
+                await report_to.send(f"❌ XP recalculation failed: {e}")
+        finally:
+            if snapshot is not None:
+                # whatever made it into a checkpoint stays for the resume
+                snapshot.close()
+            if reporter is not None:
+                reporter.cancel()
+            crawler.cancel()
+            if self.recalc_jobs.get(guild_id) is job:
+                del self.recalc_jobs[guild_id]
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    @commands.cooldown(1, 60 * 60 * 24 * 7, BucketType.guild)
+    async def recalculateguildxp(self, ctx: commands.Context):
+        """
+        recalculate guild's XP from message history
+        """
+        if ctx.guild.id in self.recalc_jobs:
+            await ctx.reply("❌ XP is already being recalculated in this server. See `m.recalcstatus`.")
+            return
+        timeout = (await serverconfig.get(ctx.guild.id)).time_between_xp
+        if timeout is None:
+            timeout = 60
+        msg = await ctx.reply("Recalculating XP... this will take a while. "
+                              "Check on it with `m.recalcstatus` or stop it with `m.recalccancel`.")
+        await database.db.execute("INSERT INTO xp_recalc_jobs(guild, channel, message, time_between_xp) "
+                                  "VALUES (?,?,?,?)", (ctx.guild.id, ctx.channel.id, msg.id, timeout))
+        await database.commit()
+        self.start_recalc(ctx.guild.id)
+
+    @commands.command(aliases=["recalculatestatus"])
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def recalcstatus(self, ctx: commands.Context):
+        """
+        see how far along this server's XP recalculation is
+        """
+        job = self.recalc_jobs.get(ctx.guild.id)
+        if job is None:
+            await ctx.reply("No XP recalculation is running in this server.")
+        else:
+            await ctx.reply(f"Recalculating XP... {job.status}")
+
+    @commands.command(aliases=["cancelrecalc", "recalculatecancel"])
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def recalccancel(self, ctx: commands.Context):
+        """
+        stop this server's XP recalculation. nobody's XP is changed.
+        """
+        job = self.recalc_jobs.pop(ctx.guild.id, None)
+        if job is None:
+            await ctx.reply("No XP recalculation is running in this server.")
+            return
+        job.task.cancel()
+        try:
+            await job.task
+        except asyncio.CancelledError:
+            pass
+        await self.delete_recalc(ctx.guild.id)
+        xpengine.delete_partial(ctx.guild.id)
+        # it never finished, so don't make them wait a week to try again
+        self.recalculateguildxp.reset_cooldown(ctx)
+        await ctx.reply("✔️ Cancelled XP recalculation.")
+
+    @commands.command(aliases=["xppreview", "previewxpcooldown"])
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def xpwhatif(self, ctx: commands.Context, cooldown: float):
+        """
+        preview everyone's XP with a different XP cooldown, using the messages counted by the last recalculateguildxp.
+        nobody's XP is changed.
+
+        :param ctx: discord context
+        :param cooldown: amount of seconds between XP gains to try.
+        """
+        assert cooldown >= 0, "cooldown must be 0 or more"
+        current = (await serverconfig.get(ctx.guild.id)).time_between_xp
+        if current is None:
+            current = 60
+        async with database.read("SELECT userorchannel FROM guild_xp_exclusions WHERE guild=? AND mod_set=true",
+                                 (ctx.guild.id,)) as cur:
+            excl = {row[0] for row in await cur.fetchall()}
+        async with ctx.typing():
+            result = await asyncio.to_thread(xpengine.whatif, ctx.guild.id, cooldown, current, excl)
+        if result is None:
+            await ctx.reply("❌ There are no counted messages to preview with yet. Run `m.recalculateguildxp` first.")
+            return
+        messages, users, xp, currentxp = result
+        text = f"From {messages:,} messages by {len(users):,} users:\n" \
+               f"a **{cooldown:g} second** cooldown would give **{int(xp.sum()):,}** XP, " \
+               f"the current **{current:g} second** cooldown gives **{int(currentxp.sum()):,}** XP.\n"
+        for rank, i in enumerate(xp.argsort()[::-1][:10], start=1):
+            text += f"**#{rank}** <@{users[i]}> **{xp[i]:,}** XP (currently {currentxp[i]:,})\n"
+        await ctx.reply(text, allowed_mentions=discord.AllowedMentions.none())
 
     # TODO: add option to exclude all child threads
     @moderation.mod_only()
@@ -238,17 +982,22 @@ class ExperienceCog(commands.Cog, name="Experience"):
         :param userorchannel: user or channel to disallow gaining XP.
         """
         async with database.db.execute("SELECT 1 FROM guild_xp_exclusions WHERE guild=? AND userorchannel=?",
-                                       (ctx.guild.id, ctx.author.id)) as cur:
+                                       (ctx.guild.id, userorchannel.id)) as cur:
             if await cur.fetchone() is not None:
                 exists = True
                 await database.db.execute("DELETE FROM guild_xp_exclusions WHERE guild=? AND userorchannel=?",
-                                          (ctx.guild.id, ctx.author.id))
+                                          (ctx.guild.id, userorchannel.id))
             else:
                 exists = False
                 await database.db.execute(
                     "INSERT INTO guild_xp_exclusions(guild, userorchannel, mod_set) VALUES (?,?,true)",
                     (ctx.guild.id, userorchannel.id))
-            await database.db.commit()
+            await database.commit()
+        excl = await self.get_exclusions(ctx.guild.id)
+        if exists:
+            excl.discard(userorchannel.id)
+        else:
+            excl.add(userorchannel.id)
         await ctx.reply(f"✔️ {'Unexcluded' if exists else 'Excluded'} {userorchannel.mention} from XP.")
 
     @commands.command()
@@ -265,13 +1014,15 @@ class ExperienceCog(commands.Cog, name="Experience"):
                 await database.db.execute(
                     "INSERT INTO guild_xp_exclusions(guild, userorchannel, mod_set) VALUES (?,?,false)",
                     (ctx.guild.id, ctx.author.id))
-                await database.db.commit()
+                await database.commit()
+                (await self.get_exclusions(ctx.guild.id)).add(ctx.author.id)
             # user is excluded but not by a mod
             elif not res[0]:
                 result = "Enabled"
                 await database.db.execute("DELETE FROM guild_xp_exclusions WHERE guild=? AND userorchannel=?",
                                           (ctx.guild.id, ctx.author.id))
-                await database.db.commit()
+                await database.commit()
+                (await self.get_exclusions(ctx.guild.id)).discard(ctx.author.id)
             # user is excluded by a mod, dont let them reenable xp on their own
             else:
                 result = "Blocked"
@@ -292,24 +1043,18 @@ class ExperienceCog(commands.Cog, name="Experience"):
         # https://www.wolframalpha.com/input/?i=sum+from+0+to+x+yx
         if user is None:
             user = ctx.author
-        async with database.db.execute("SELECT experience, experience_rank FROM (SELECT experience, RANK() OVER "
-                                       "(ORDER BY experience DESC) experience_rank, user FROM experience "
-                                       "WHERE guild = ?) WHERE user=?",
-                                       (ctx.guild.id, user.id)) as cur:
-            exp = await cur.fetchone()
+        # pending XP changes the ranks of everyone in the guild, not just this user
+        await self.flush_xp(ctx.guild.id)
+        exp = (await self.get_rank_index(ctx.guild.id)).rank(user.id)
         if exp is None:
             exp = 0
             rank = None
         else:
             exp, rank = exp
-        async with database.db.execute("SELECT xp_change_per_level FROM server_config WHERE guild=?",
-                                       (ctx.guild.id,)) as cur:
-            change_per_level = await cur.fetchone()
+        change_per_level = (await serverconfig.get(ctx.guild.id)).xp_change_per_level
         if change_per_level is None:
             # default
             change_per_level = 30
-        else:
-            change_per_level = change_per_level[0]
         level = xp_to_level(exp, change_per_level)
         xp_for_current_level = level_to_xp(level, change_per_level)
         xp_for_next_level = level_to_xp(level + 1, change_per_level)
@@ -347,12 +1092,9 @@ class ExperienceCog(commands.Cog, name="Experience"):
                         inline=False)
         embed2 = discord.Embed(color=discord.Color(0xf6f121), title=f"Experience in {ctx.guild}")
         embed2.set_thumbnail(url=ctx.guild.icon.url)
-        async with database.db.execute("SELECT time_between_xp, xp_change_per_level FROM server_config WHERE guild=?",
-                                       (ctx.guild.id,)) as cur:
-            xpinfo = await cur.fetchone()
-        if xpinfo is None:
-            xpinfo = 60, 30
-        time_between_xp, xp_change_per_level = xpinfo
+        conf = await serverconfig.get(ctx.guild.id)
+        time_between_xp = 60 if conf.time_between_xp is None else conf.time_between_xp
+        xp_change_per_level = 30 if conf.xp_change_per_level is None else conf.xp_change_per_level
         embed2.add_field(name="Server Delay Between XP Gain",
                          value=f"You can only gain XP every {time_between_xp:g} seconds in this server.", inline=False)
         embed2.add_field(name="Server XP change per level",
@@ -368,41 +1110,9 @@ class ExperienceCog(commands.Cog, name="Experience"):
         :param page: page of results
         """
         assert page > 0, "Page must be 1 or more"
-        async with database.db.execute(f"SELECT user, experience, RANK() OVER (ORDER BY experience DESC) "
-                                       f"experience_rank FROM experience WHERE guild = ? "
-                                       f"LIMIT 10 OFFSET {(page - 1) * 10}",
-                                       (ctx.guild.id,)) as cur:
-            rows = await cur.fetchall()
-        embed = discord.Embed(color=discord.Color(0x15fe02), title=ctx.guild.name,
-                              description=f"Page {page}")
-        embed.set_thumbnail(url=ctx.guild.icon.url)
-        if rows:
-            # get guild xp settings
-            async with database.db.execute("SELECT xp_change_per_level FROM server_config WHERE guild=?",
-                                           (ctx.guild.id,)) as cur:
-                change_per_level = await cur.fetchone()
-            if change_per_level is None:
-                # default
-                change_per_level = 30
-            else:
-                change_per_level = change_per_level[0]
-            # get top xp to make bar
-            async with database.db.execute("SELECT experience FROM experience WHERE guild=? ORDER BY experience DESC",
-                                           (ctx.guild.id,)) as cur:
-                topxp = (await cur.fetchone())[0]
-            # format leaderboard
-            text = ""
-            for row in rows:
-                user, experience, rank = row
-                text += f"**#{rank}** <@{user}>\n" \
-                        f"Level **{xp_to_level(experience, change_per_level)}** " \
-                        f"`{progress_bar(experience, topxp, 20)}` " \
-                        f"**{si_prefix.si_prefix(experience)}** XP\n"
-            embed.add_field(name="Leaderboard", value=text)
-        else:
-            embed.add_field(name="No users found!",
-                            value="Try going back a page and making sure experience is enabled in this server")
-        await ctx.reply(embed=embed)
+        view = LeaderboardView(self, ctx)
+        await view.load(page)
+        await ctx.reply(embed=await view.embed(), view=view)
 
     # TODO: serverwide disable or enable
 
@@ -437,9 +1147,11 @@ class ExperienceCog(commands.Cog, name="Experience"):
         :param ctx:
         :param user: the user to reset the XP for
         """
-
+        await self.flush_xp(ctx.guild.id)
         await database.db.execute("DELETE FROM experience WHERE user=? AND guild=?", (user.id, ctx.guild.id))
-        await database.db.commit()
+        await database.commit()
+        if ctx.guild.id in self.rank_indexes:
+            self.rank_indexes[ctx.guild.id].remove(user.id)
         await modlog.modlog(f"{ctx.author.mention} ({ctx.author}) reset {user.mention} ({user})'s XP.",
                             ctx.guild.id, ctx.author.id)
         await ctx.reply(f"✔ Reset {user.mention}'s XP.")
@@ -466,8 +1178,10 @@ class ExperienceCog(commands.Cog, name="Experience"):
             if msg.content == confirmstring:
                 try:
                     self.suspended_guild.append(ctx.guild.id)
+                    await self.flush_xp(ctx.guild.id)
                     await database.db.execute("DELETE FROM experience WHERE guild=?", (ctx.guild.id,))
-                    await database.db.commit()
+                    await database.commit()
+                    self.rank_indexes.pop(ctx.guild.id, None)
                     self.suspended_guild.remove(ctx.guild.id)
                 except Exception as e:
                     self.suspended_guild.remove(ctx.guild.id)
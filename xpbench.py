@@ -0,0 +1,183 @@
+"""
+benchmarks for the XP system, so changes to it can be compared with numbers instead of vibes.
+
+    python xpbench.py onmessage --messages 200000 --users 5000 --guilds 20
+    python xpbench.py recalc --messages 5000000 --channels 200
+    python xpbench.py engine --messages 10000000
+
+each run prints messages/sec, handler latency percentiles where it makes sense, and the peak RSS of the process, so
+run one benchmark per process.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import database
+import migrations
+import serverconfig
+import xp
+import xpengine
+from clogs import logger
+from perfstats import LatencyStats
+
+
+def peak_rss() -> str:
+    # linux reports kilobytes, mac reports bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return f"{peak / (1024 * 1024 if sys.platform == 'darwin' else 1024):,.1f}MiB"
+
+
+def format_us(seconds: float) -> str:
+    # handlers are way under a millisecond, format_ms would just say 0.0ms
+    return f"{seconds * 1_000_000:,.1f}us"
+
+
+def report(name: str, messages: int, seconds: float, latency: LatencyStats = None):
+    print(f"{name}: {messages:,} messages in {seconds:.2f}s, {messages / seconds:,.0f} msgs/sec")
+    if latency is not None:
+        print(f"  handler latency p50 {format_us(latency.percentile(50))}, p99 {format_us(latency.percentile(99))}, "
+              f"max {format_us(latency.percentile(100))}")
+    print(f"  peak RSS {peak_rss()}")
+
+
+def synthetic_message(user: int, guild: int, channel: int, created_at: datetime):
+    # only the attributes ExperienceCog.on_message reads
+    return types.SimpleNamespace(author=types.SimpleNamespace(id=user, bot=False),
+                                 guild=types.SimpleNamespace(id=guild), channel=types.SimpleNamespace(id=channel),
+                                 created_at=created_at)
+
+
+class BenchBot:
+    """just enough of a bot for ExperienceCog"""
+    user = None
+
+    async def wait_until_ready(self):
+        pass
+
+
+async def bench_onmessage(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.path = os.path.join(tmp, "database.sqlite")
+        con = sqlite3.connect(database.path)
+        with open("makedatabase.sql") as f:
+            con.executescript(f.read())
+        migrations.migrate(con)
+        con.close()
+        await database.create_db()
+        for guild in range(1, args.guilds + 1):
+            serverconfig.configs[guild] = serverconfig.ServerConfig(guild, time_between_xp=args.cooldown)
+        cog = xp.ExperienceCog(BenchBot())
+        await cog.cog_load()
+        rng = random.Random(args.seed)
+        latency = LatencyStats(window=args.messages)
+        interval = 1 / args.rate if args.rate else 0
+        start = time.perf_counter()
+        for i in range(args.messages):
+            if interval:
+                # pace to the target rate, sleeping off any time we're ahead
+                ahead = start + i * interval - time.perf_counter()
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+            guild = rng.randint(1, args.guilds)
+            message = synthetic_message(rng.randint(1, args.users), guild, guild * 1000 + rng.randint(1, 10),
+                                        datetime.now(tz=timezone.utc))
+            handler_start = time.perf_counter()
+            await cog.on_message(message)
+            latency.add(time.perf_counter() - handler_start)
+        # include getting everything onto disk
+        await cog.cog_unload()
+        elapsed = time.perf_counter() - start
+        await database.close()
+    report("on_message", args.messages, elapsed, latency)
+
+
+def synthetic_history(rng: np.random.Generator, messages: int, users: int, channels: int, days: int) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    :return: (channel index, user id, epoch seconds) of every message, sorted by time
+    """
+    now = datetime.now(tz=timezone.utc).timestamp()
+    times = np.sort(rng.uniform(now - timedelta(days=days).total_seconds(), now, messages))
+    # some users and channels are much more active than others, like real guilds
+    user_ids = rng.zipf(1.3, messages) % users + 1
+    channel_ids = rng.zipf(1.3, messages) % channels
+    return channel_ids, user_ids, times
+
+
+async def bench_recalc(args):
+    rng = np.random.default_rng(args.seed)
+    channel_ids, user_ids, times = synthetic_history(rng, args.messages, args.users, args.channels, args.days)
+    # split per channel up front so none of it lands in the timing. a stable sort keeps each channel oldest first
+    order = np.argsort(channel_ids, kind="stable")
+    bounds = np.searchsorted(channel_ids[order], np.arange(args.channels + 1))
+    channels = [(times[order[bounds[c]:bounds[c + 1]]], user_ids[order[bounds[c]:bounds[c + 1]]])
+                for c in range(args.channels)]
+    del channel_ids, user_ids, times, order
+    print(f"  peak RSS after generating history {peak_rss()}")
+
+    async def channel_stream(channel_times: np.ndarray, channel_users: np.ndarray):
+        # what HistoryCrawler streams look like, (timestamp, author, message id), oldest first. converted a page at a
+        # time like the crawler gets them, not a whole channel at once
+        message_id = 0
+        for start in range(0, len(channel_times), 100):
+            for timestamp, user in zip(channel_times[start:start + 100].tolist(),
+                                       channel_users[start:start + 100].tolist()):
+                yield timestamp, user, message_id
+                message_id += 1
+
+    start = time.perf_counter()
+    counter = xp.XPCounter(args.cooldown)
+    async for i, (timestamp, user, message) in xp.merge_messages([channel_stream(*c) for c in channels]):
+        counter.count(user, timestamp)
+    elapsed = time.perf_counter() - start
+    report("recalculation merge and count", args.messages, elapsed)
+    print(f"  {sum(counter.xps.values()):,} XP for {len(counter.xps):,} users")
+
+
+def bench_engine(args):
+    rng = np.random.default_rng(args.seed)
+    _, user_ids, times = synthetic_history(rng, args.messages, args.users, 1, args.days)
+    times_ms = (times * 1000).astype(np.int64)
+    start = time.perf_counter()
+    users, xps = xpengine.compute_xp(user_ids.astype(np.int64), times_ms, args.cooldown)
+    elapsed = time.perf_counter() - start
+    report("numpy engine", args.messages, elapsed)
+    print(f"  {int(xps.sum()):,} XP for {len(users):,} users")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the XP system")
+    parser.add_argument("benchmark", choices=["onmessage", "recalc", "engine"])
+    parser.add_argument("--messages", type=int, default=1_000_000, help="how many synthetic messages")
+    parser.add_argument("--users", type=int, default=10_000, help="how many distinct users")
+    parser.add_argument("--guilds", type=int, default=10, help="onmessage: how many guilds")
+    parser.add_argument("--channels", type=int, default=100, help="recalc: how many channels to merge")
+    parser.add_argument("--days", type=int, default=365, help="recalc/engine: how much history to spread over")
+    parser.add_argument("--rate", type=float, default=0, help="onmessage: target msgs/sec, 0 for as fast as possible")
+    parser.add_argument("--cooldown", type=float, default=60, help="seconds between XP gains")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--debug", action="store_true", help="keep debug logs, which on_message writes per message")
+    args = parser.parse_args()
+    if not args.debug:
+        logger.setLevel(logging.INFO)
+    if args.benchmark == "onmessage":
+        asyncio.run(bench_onmessage(args))
+    elif args.benchmark == "recalc":
+        asyncio.run(bench_recalc(args))
+    else:
+        bench_engine(args)
+
+
+if __name__ == "__main__":
+    main()
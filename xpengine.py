@@ -0,0 +1,200 @@
+import array
+import math
+import os
+import time
+import typing
+
+import numpy as np
+
+# recalculateguildxp leaves a copy of every message it counted here, one file per guild, for xpwhatif. they're 16
+# bytes per message so they don't get to stay forever:
+snapshot_dir = "xpsnapshots"
+# ...snapshots older than this many days get deleted, XP has moved on a lot by then anyway...
+snapshot_max_age_days = 90
+# ...and once all of them together are bigger than this many bytes, the oldest go until they aren't
+snapshot_max_bytes = 2 * 1024 ** 3
+
+
+def snapshot_path(guild: int, partial: bool = False) -> str:
+    """
+    where a guild's message snapshot lives. a recalculation writes to the partial file and renames it when it finishes
+    :param guild: guild id
+    :param partial: the file of a recalculation that's still running
+    :return: path to the file
+    """
+    return os.path.join(snapshot_dir, f"{guild}.partial" if partial else f"{guild}.bin")
+
+
+def load_snapshot(guild: int) -> typing.Optional[tuple[np.ndarray, np.ndarray]]:
+    """
+    read a guild's finished snapshot. the file is just (user id, epoch milliseconds) int64 pairs back to back.
+    :param guild: guild id
+    :return: (user ids, epoch milliseconds) as int64 arrays with one entry per message, None if there's no snapshot
+    """
+    try:
+        pairs = np.fromfile(snapshot_path(guild), dtype=np.int64).reshape(-1, 2)
+    except FileNotFoundError:
+        return None
+    return pairs[:, 0], pairs[:, 1]
+
+
+def delete_partial(guild: int):
+    """throw away the snapshot of a recalculation that isn't going to finish"""
+    try:
+        os.remove(snapshot_path(guild, partial=True))
+    except FileNotFoundError:
+        pass
+
+
+def delete_snapshot(guild: int):
+    """throw away a guild's finished snapshot"""
+    try:
+        os.remove(snapshot_path(guild))
+    except FileNotFoundError:
+        pass
+
+
+def prune_snapshots():
+    """delete finished snapshots past snapshot_max_age_days, then the oldest ones until under snapshot_max_bytes"""
+    try:
+        names = [name for name in os.listdir(snapshot_dir) if name.endswith(".bin")]
+    except FileNotFoundError:
+        return
+    snapshots = []
+    for name in names:
+        path = os.path.join(snapshot_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        snapshots.append((stat.st_mtime, stat.st_size, path))
+    # newest first, so whatever is left once the total gets too big is the oldest
+    snapshots.sort(reverse=True)
+    oldest_allowed = time.time() - snapshot_max_age_days * 24 * 60 * 60
+    total = 0
+    for mtime, size, path in snapshots:
+        total += size
+        if mtime < oldest_allowed or total > snapshot_max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SnapshotWriter:
+    """
+    appends (user id, epoch milliseconds) pairs to a guild's partial snapshot. rows are buffered in memory until
+    write(), which returns how many rows the file holds so the caller can checkpoint that number and resume from it.
+    """
+
+    def __init__(self, guild: int, rows: int = 0):
+        """
+        :param guild: guild id
+        :param rows: how many rows the checkpoint being resumed from had, anything after them is cut off. 0 to start
+        over.
+        :raises ValueError: if the file doesn't have that many rows anymore
+        """
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.guild = guild
+        self.path = snapshot_path(guild, partial=True)
+        self.file = open(self.path, "ab")
+        if os.path.getsize(self.path) < rows * 16:
+            self.file.close()
+            raise ValueError(f"snapshot for {guild} is missing rows, can't resume it")
+        self.file.truncate(rows * 16)
+        self.rows = rows
+        self.buffer = array.array("q")
+
+    def add(self, user: int, timestamp: int):
+        self.buffer.append(user)
+        self.buffer.append(timestamp)
+
+    def write(self) -> int:
+        """
+        write buffered rows to disk
+        :return: how many rows the file holds now
+        """
+        self.buffer.tofile(self.file)
+        self.file.flush()
+        self.rows += len(self.buffer) // 2
+        self.buffer = array.array("q")
+        return self.rows
+
+    def close(self):
+        self.file.close()
+
+    def finish(self):
+        """write what's left and make this the guild's snapshot, replacing the old one"""
+        self.write()
+        self.close()
+        os.replace(self.path, snapshot_path(self.guild))
+
+
+def compute_xp(users: np.ndarray, times: np.ndarray, cooldown: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    XP for every user from their messages, the same way on_message gives it out: a message gains XP if at least
+    `cooldown` seconds have passed since the last message that gained XP. that last part is why it can't be a diff of
+    neighbouring messages, a message that didn't gain XP doesn't restart the cooldown.
+
+    instead, every message points at the first message by the same user at least `cooldown` after it (a searchsorted),
+    which is the next one that gains XP if this one did. the messages that gain XP are the chain of pointers starting
+    at each user's first message, and the chain lengths come out of pointer jumping in O(log longest chain) passes.
+
+    :param users: int64 user id of each message
+    :param times: int64 epoch milliseconds of each message, in any order
+    :param cooldown: seconds between XP gains
+    :return: (user ids, XP of each) as int64 arrays
+    """
+    n = len(users)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # group by user, oldest first within each user
+    order = np.lexsort((times, users))
+    users = users[order]
+    times = times[order] - times.min()
+    # index of the first message of each user's run
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    segment = np.cumsum(np.r_[True, users[1:] != users[:-1]]) - 1
+    # offset each user's run past the end of the one before it, plus more than the cooldown, so one searchsorted over
+    # the whole array can never land in the next user's run
+    cooldown_ms = math.ceil(cooldown * 1000)
+    spacing = int(times.max()) + cooldown_ms + 1
+    shifted = times + segment * spacing
+    # the next message that gains XP if this one did, or n for none
+    nxt = np.searchsorted(shifted, shifted + cooldown_ms, side="left")
+    # a cooldown of 0 still can't point a message at itself or an earlier one with the same timestamp
+    np.maximum(nxt, np.arange(1, n + 1), out=nxt)
+    ends = np.r_[starts[1:], n][segment]
+    nxt[nxt >= ends] = n
+    # pointer jumping: count[i] is how many XP gaining messages from i (inclusive) up to ptr[i] (exclusive).
+    # index n is the end of every chain
+    ptr = np.r_[nxt, n]
+    count = np.ones(n + 1, dtype=np.int64)
+    count[n] = 0
+    while not (ptr[starts] == n).all():
+        count += count[ptr]
+        ptr = ptr[ptr]
+    return users[starts], count[starts]
+
+
+def whatif(guild: int, cooldown: float, current_cooldown: float, excluded: typing.Collection[int]) \
+        -> typing.Optional[tuple[int, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    XP everyone would have with a different cooldown, from the guild's snapshot. slow enough to want a thread.
+    :param guild: guild id
+    :param cooldown: cooldown to try, in seconds
+    :param current_cooldown: cooldown to compare against, in seconds
+    :param excluded: user ids to leave out
+    :return: (number of messages, user ids, XP with cooldown, XP with current_cooldown), None if there's no snapshot
+    """
+    snapshot = load_snapshot(guild)
+    if snapshot is None:
+        return None
+    users, times = snapshot
+    if excluded:
+        keep = ~np.isin(users, np.fromiter(excluded, dtype=np.int64))
+        users, times = users[keep], times[keep]
+    # same users in the same order both times, since that only depends on the messages
+    ids, xp = compute_xp(users, times, cooldown)
+    _, currentxp = compute_xp(users, times, current_cooldown)
+    return len(users), ids, xp, currentxp